@@ -0,0 +1,211 @@
+# -----------------------------------------------------------------------------
+#
+# Server micro benchmarks
+#
+#   python bench.py [name ...]
+#
+# Every benchmark builds what it needs in memory, no map file is loaded.
+# Names default to all of them.
+# -----------------------------------------------------------------------------
+
+import numpy
+import random
+import sys
+import time
+
+from chattr import (Avatar, Channel, ChannelCollection, Map, SimulatedWanderer,
+                    Tile, Wanderer)
+from chattr.collision import Collisions
+from chattr.simulation import Simulation
+from chattr.vector import Vector, VectorArray
+from chattr.protocol import PROTOCOLS
+
+
+def timed(fn, repeat=10):
+    fn()
+
+    start = time.time()
+    for i in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
+
+
+def report(name, **columns):
+    cols = ' '.join('%s=%s' % (k, columns[k]) for k in sorted(columns))
+    print '%-24s %s' % (name, cols)
+
+
+def bench_broadcast():
+    avatar = Avatar()
+
+    for clients in (1, 10, 100, 1000):
+        channels = ChannelCollection()
+        for i in range(clients):
+            channels.add(Avatar(), Channel(None))
+
+        def drain():
+            for uid, channel in channels.items():
+                channel.outgoing.clear()
+
+        def per_channel():
+            for uid, channel in channels.items():
+                channel.send('update', avatar)
+            drain()
+
+        def shared():
+            channels.broadcast('update', avatar)
+            drain()
+
+        t_per = timed(per_channel)
+        t_shared = timed(shared)
+
+        report('broadcast/%d' % clients,
+               per_channel_ms='%.3f' % (t_per * 1000),
+               shared_ms='%.3f' % (t_shared * 1000),
+               speedup='%.1fx' % (t_per / t_shared))
+
+
+def bench_protocol():
+    avatars = [Avatar() for i in range(100)]
+    for avatar in avatars:
+        avatar.mark_clean()
+        avatar.move(avatar.velocity)
+
+    for name, protocol in sorted(PROTOCOLS.items()):
+        def frame():
+            update = [protocol.encode_delta(a) for a in avatars]
+            return protocol.encode_frame(0, False, [], update, [])
+
+        report('protocol/%s' % name,
+               frame_bytes=len(frame()),
+               encode_ms='%.3f' % (timed(frame) * 1000))
+
+
+def bench_simulation():
+    for count in (1000, 10000, 100000):
+        wanderers = [Wanderer(100) for i in range(count)]
+
+        def objects():
+            for wanderer in wanderers:
+                wanderer.tick(100)
+
+        simulation = Simulation(count)
+        for i in range(count):
+            SimulatedWanderer(simulation, 100)
+
+        def arrays():
+            simulation.tick(100, Avatar.SPEED)
+
+        repeat = max(100000 / count, 3)
+        t_objects = timed(objects, repeat)
+        t_arrays = timed(arrays, repeat)
+
+        report('simulation/%d' % count,
+               objects_tps='%.1f' % (1 / t_objects),
+               arrays_tps='%.1f' % (1 / t_arrays),
+               speedup='%.1fx' % (t_objects / t_arrays))
+
+
+def bench_collision():
+    # a crowd packed about one avatar per 40x40 pixels, everybody moving
+    for count in (250, 1000, 4000):
+        side = int(count ** 0.5 * 40)
+        tiles = side // 32 + 1
+        map = Map([Tile('grass', 0, 1, 32, 32)],
+                  numpy.zeros((tiles, tiles)), 'terrain-tiles')
+
+        collisions = Collisions(map)
+        avatars = [Avatar() for i in range(count)]
+        for avatar in avatars:
+            avatar.position = Vector(random.uniform(0, side),
+                                     random.uniform(0, side))
+            collisions.add(avatar)
+
+        def jostle():
+            for avatar in avatars:
+                p = avatar.position
+                avatar.position = Vector(
+                    min(max(p.x + random.uniform(-1, 1), 0), side - 1),
+                    min(max(p.y + random.uniform(-1, 1), 0), side - 1))
+
+        def grid():
+            jostle()
+            collisions.resolve(avatars)
+
+        def pairwise():
+            jostle()
+            for avatar in avatars:
+                p = avatar.position
+                for other in avatars:
+                    if other is avatar:
+                        continue
+
+                    q = other.position
+                    dx, dy = p.x - q.x, p.y - q.y
+                    reach = avatar.size + other.size
+                    if dx * dx + dy * dy < reach * reach:
+                        pass
+
+        t_grid = timed(grid, 5)
+        columns = dict(grid_ms='%.1f' % (t_grid * 1000))
+
+        # quadratic, only bearable for small crowds
+        if count <= 1000:
+            t_pairwise = timed(pairwise, 1)
+            columns['pairwise_ms'] = '%.1f' % (t_pairwise * 1000)
+            columns['speedup'] = '%.1fx' % (t_pairwise / t_grid)
+
+        report('collision/%d' % count, **columns)
+
+
+def bench_vector():
+    a, b, out = Vector(3.0, 4.0), Vector(1.5, -2.0), Vector()
+    n = 100000
+
+    def per_op(fn):
+        ops = [None] * n
+        return timed(lambda: [fn() for i in ops], 3) / n
+
+    ops = [('add', lambda: a + b),
+           ('iadd', lambda: out.__iadd__(b)),
+           ('sub_into', lambda: a.sub_into(b, out)),
+           ('scale_into', lambda: a.scale_into(2.0, out)),
+           ('add_scaled', lambda: out.add_scaled(b, 0.5)),
+           ('distance', lambda: a.distance(b)),
+           ('distance_sq', lambda: a.distance_sq(b)),
+           ('within', lambda: a.within(b, 5.0)),
+           ('unit', lambda: a.unit()),
+           ('getitem', lambda: a[1]),
+           ('setitem', lambda: out.__setitem__(1, 2.0))]
+
+    for name, fn in ops:
+        report('vector/%s' % name, ns='%.0f' % (per_op(fn) * 1e9))
+
+    # a radius query over many points, one at a time and batched
+    for count in (100, 10000):
+        points = [Vector(random.uniform(0, 1000), random.uniform(0, 1000))
+                  for i in range(count)]
+        array = VectorArray.from_vectors(points)
+        center = Vector(500.0, 500.0)
+
+        t_loop = timed(lambda: [p for p in points if p.within(center, 100)])
+        t_array = timed(lambda: array.within(center, 100))
+
+        report('vector/within/%d' % count,
+               loop_us='%.1f' % (t_loop * 1e6),
+               array_us='%.1f' % (t_array * 1e6),
+               speedup='%.1fx' % (t_loop / t_array))
+
+
+BENCHMARKS = dict((k[len('bench_'):], v) for k, v in globals().items()
+                  if k.startswith('bench_'))
+
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+
+    for name in names:
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
@@ -9,107 +9,283 @@
 # http://code.google.com/p/canvasimagegradient/source/browse/trunk/canvasImageGradient.js
 # -----------------------------------------------------------------------------
 
-from gevent import monkey, Greenlet
-from gevent.queue import Queue, Empty
-from gevent.pywsgi import WSGIServer
+# gevent patches the standard library before anything else is imported.
+# Scripts that only want the map classes and must keep the real threads and
+# processes, like map.py, set CHATTR_NO_PATCH first.
+import os
+if not os.environ.get('CHATTR_NO_PATCH'):
+    from gevent import monkey
+    monkey.patch_all()
+
+from gevent import Greenlet
 import gevent
-monkey.patch_all()
 
-from geventwebsocket import WebSocketHandler, WebSocketError
+from geventwebsocket import WebSocketError
 
-from pyramid.config import Configurator
-from pyramid.view import view_config
-
-import json
+from collections import deque
+import heapq
+import itertools
 import logging
 import random
+import socket
 import time
 import uuid
 import code
 import signal
 
+from chattr.collision import Collisions
+from chattr.connections import ConnectionManager
+from chattr.metrics import Counter, Gauge, Histogram, Registry
+from chattr.pathfinding import PathService
+from chattr.protocol import (finite, json_encoder, message, flatten_message,
+                             parse_message, negotiate)
+from chattr.rng import Rng
+from chattr.scheduler import Scheduler
+from chattr.simulation import Simulation
+from chattr.spatial import SpatialGrid
+from chattr.terrain import Map, Tile
+from chattr.throttle import InputQueue, RateLimiter
 from chattr.vector import Vector
 
 log = logging.getLogger(__name__)
 
 
-def json_encoder(obj):
-    if hasattr(obj, '__json__'):
-        return obj.__json__()
+class OutgoingQueue(object):
+    """
+    Frames waiting to be written to a client, bounded by their total size.
+    Putting never blocks, so a slow client can not stall the world, instead
+    Channel.send_frame decides what to drop when the queue is full.  Frames
+    are popped by the ConnectionManager's writers.
+    """
+
+    # frames that must arrive, avatar state superseded by the next full
+    # snapshot, and frames that can be lost
+    CRITICAL, STATE, DROPPABLE = range(3)
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.frames = deque()
+
+    def qsize(self):
+        return len(self.frames)
+
+    def empty(self):
+        return not self.frames
+
+    def fits(self, frame):
+        return self.bytes + len(frame) <= self.max_bytes
+
+    def count(self, kind):
+        return sum(1 for k, frame in self.frames if k == kind)
+
+    def put(self, frame, kind=CRITICAL):
+        self.bytes += len(frame)
+        self.frames.append((kind, frame))
+
+    def pop(self):
+        kind, frame = self.frames.popleft()
+        self.bytes -= len(frame)
+        return frame
 
-    raise TypeError('%s is not JSON serializable' % obj)
+    def discard(self, kind):
+        kept = deque((k, f) for k, f in self.frames if k != kind)
+        dropped = len(self.frames) - len(kept)
 
-message = lambda type_, data=None: {'type': type_, 'data': data}
-flatten_message = lambda msg: json.dumps(msg, default=json_encoder)
-parse_message = lambda data: json.loads(data)
+        self.frames = kept
+        self.bytes = sum(len(f) for k, f in kept)
+        return dropped
+
+    def clear(self):
+        self.frames.clear()
+        self.bytes = 0
 
 
-# FIXME throttle incoming/outgoing
 class Channel(object):
-    def __init__(self, socket):
+    # seconds between pings
+    PING_INTERVAL = 10
+
+    # (messages per second, burst) a client may send per message type, None
+    # is the limit over all types, anything past it is dropped unread
+    RATE_LIMITS = {None: (50, 100),
+                   'input': (30, 60),
+                   'click': (10, 20),
+                   'dblclick': (10, 20)}
+
+    # the only messages a client may send, spawn and die are the world's own
+    CLIENT_MESSAGES = frozenset(['pong', 'input', 'click', 'dblclick'])
+
+    # outgoing bytes a client may have queued before frames get dropped, and
+    # how many state frames it may be behind before it is resynced instead
+    MAX_QUEUE_BYTES = 1024 * 1024
+    MAX_PENDING_FRAMES = 5
+
+    def __init__(self, socket, protocol=None, manager=None):
         self.socket = socket
+        self.protocol = protocol or negotiate(None)
+
+        # writes frames and sends pings for every channel
+        self.manager = manager or Connections
 
         self.running = False
 
-        self.incoming = Queue(None)
-        self.outgoing = Queue(None)
+        # why the server dropped the client, if it did
+        self.closed = None
 
-        self.reader = Greenlet(self.do_read)
-        self.writer = Greenlet(self.do_write)
-        self.pinger = Greenlet(self.do_ping)
+        self.outgoing = OutgoingQueue(self.MAX_QUEUE_BYTES)
 
-    def do_read(self):
-        while self.running:
-            data = self.socket.receive()
+        # uids of the avatars this client has been told about
+        self.interest = set()
 
-            if not data:
-                break
+        # tick of the last full snapshot sent
+        self.keyframe = None
 
-            try:
-                self.incoming.put(parse_message(data))
-            except WebSocketError, e:
-                log.error('Error receiving on websocket: %s', e)
-                self.running = False
-                self.outgoing.put(None)
+        # map chunks the client has, and the chunk its avatar was last in
+        self.chunks = set()
+        self.chunk = None
 
-    def do_write(self):
-        while self.running:
-            try:
-                msg = self.outgoing.get()
-                if not msg:
-                    break
+        # set when state frames were dropped, the next frame must be full
+        self.resync = False
 
-                self.socket.send(flatten_message(msg))
-            except WebSocketError, e:
-                log.error('Error sending on websocket: %s', e)
-                self.running = False
-                self.incoming.put(None)
+        # consecutive ticks the client has been too far behind
+        self.lagging = 0
+
+        self.limiter = RateLimiter(self.RATE_LIMITS)
+
+        self.sent_bytes = 0
+        self.sent_messages = 0
+        self.dropped_frames = 0
+        self.throttled = 0
+        self.malformed = 0
+
+        self.ping_interval = self.PING_INTERVAL
 
     def is_running(self):
-        return self.running and not any([self.reader.ready(),
-                                         self.writer.ready()])
+        return self.running
 
     def run(self):
         self.running = True
-        self.reader.start()
-        self.writer.start()
-        self.pinger.start()
+        self.manager.add(self)
 
     def wait(self):
         self.running = False
-        gevent.killall([self.reader, self.writer])
+        self.manager.remove(self)
+
+    def shutdown(self):
+        """
+        Wake up whoever is blocked in receive().  Websockets have their socket
+        shut down, a close frame could block on a client that stopped reading.
+        """
+        sock = getattr(self.socket, 'socket', None)
+
+        try:
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+            else:
+                self.socket.close()
+        except socket.error:
+            pass
+
+    def close(self, reason):
+        """
+        Drop the client, whatever is still queued for it is thrown away.
+        """
+        log.info('closing channel: %s', reason)
+
+        self.closed = reason
+        self.running = False
+        self.outgoing.clear()
+        self.shutdown()
+
+    def congested(self):
+        outgoing = self.outgoing
+        return (outgoing.bytes * 2 > outgoing.max_bytes or
+                outgoing.count(OutgoingQueue.STATE) >= self.MAX_PENDING_FRAMES)
 
     def receive(self):
-        return self.incoming.get()
+        """
+        Read the next message off the socket, None once the client is gone.
+        Messages over the client's rate limits are dropped unread, and so are
+        binary frames, messages that are not JSON or hold numbers that are not
+        finite, and ones without data or a type a client may send.
+        """
+        while self.running:
+            try:
+                data = self.socket.receive()
+            except WebSocketError, e:
+                log.error('Error receiving on websocket: %s', e)
+                break
+
+            if not data:
+                break
+
+            # binary frames arrive as bytearrays
+            if not isinstance(data, basestring):
+                self.malformed += 1
+                continue
+
+            try:
+                msg = parse_message(data)
+            except ValueError, e:
+                log.error('Error parsing message: %s', e)
+                self.malformed += 1
+                continue
 
-    def send(self, type_, data):
-        return self.outgoing.put(message(type_, data))
+            # every handler takes data, the handlers check what it holds
+            if (not isinstance(msg, dict) or 'data' not in msg or
+                    msg.get('type') not in self.CLIENT_MESSAGES):
+                self.malformed += 1
+                continue
+
+            if not self.limiter.allow(msg['type']):
+                self.throttled += 1
+                continue
+
+            return msg
+
+        self.running = False
+        return None
+
+    def send(self, type_, data, kind=OutgoingQueue.CRITICAL):
+        return self.send_frame(self.protocol.encode(message(type_, data)),
+                               kind)
+
+    def send_frame(self, frame, kind=OutgoingQueue.CRITICAL):
+        outgoing = self.outgoing
+
+        if self.closed:
+            return False
+
+        if not outgoing.fits(frame):
+            # state is superseded by a full snapshot once the client catches
+            # up, make room by dropping it first
+            dropped = outgoing.discard(OutgoingQueue.STATE)
+            if dropped:
+                self.dropped_frames += dropped
+                self.resync = True
+
+        if not outgoing.fits(frame):
+            if kind == OutgoingQueue.CRITICAL:
+                self.close('outgoing queue overflow')
+                return False
+
+            # interest and chunks already moved past a lost state frame,
+            # only a full one puts the client right again
+            if kind == OutgoingQueue.STATE:
+                self.resync = True
+
+            self.dropped_frames += 1
+            return False
+
+        outgoing.put(frame, kind)
+        self.manager.wake(self)
+        return True
 
     def send_ping(self):
-        return self.send('ping', time.time())
+        return self.send('ping', time.time(), OutgoingQueue.DROPPABLE)
 
     def send_notice(self, msg):
-        return self.send('notice', msg)
+        return self.send('notice', msg, OutgoingQueue.DROPPABLE)
 
     def send_spawn(self, avatar):
         return self.send('spawn', avatar)
@@ -117,11 +293,14 @@ class Channel(object):
     def send_die(self, avatar):
         return self.send('die', avatar.uid)
 
+    def send_welcome(self, welcome):
+        return self.send('welcome', welcome)
+
     def send_tiles(self, tiles):
         return self.send('tiles', tiles)
 
     def send_chunk(self, chunk):
-        return self.send('chunk', list(chunk))
+        return self.send('chunk', chunk)
 
     def send_state(self, avatars):
         return self.send('state', avatars)
@@ -129,23 +308,110 @@ class Channel(object):
     def send_update(self, avatar):
         return self.send('update', avatar)
 
-    def do_ping(self):
-        while self.running:
-            gevent.sleep(10)
-            log.debug('pinging')
-            self.send_ping()
-
 
 class AvatarCollection(object):
-    def __init__(self):
+    def __init__(self, index, simulation=None, collisions=None):
         self.avatars = dict()
+        self.index = index
+        self.collisions = collisions
+
+        # simulated avatars are moved in bulk by the simulation, everybody
+        # else ticks themselves, but only while they have somewhere to go.
+        # Idle avatars sleep until something wakes them, resting ones also
+        # wake by themselves once rested, from a heap of wake up times
+        self.simulation = simulation or Simulation()
+        self.active = set()
+        self.asleep = dict()
+        self.alarms = []
+        self.alarm_ids = itertools.count()
+
+        # world time in milliseconds, as of the start of the tick
+        self.now = 0
+
+        # avatars changed since the last clean
+        self.dirtied = set()
+
+        # avatars changed and uids removed since the last snapshot, only
+        # kept once snapshots are taken
+        self.unsaved = None
+        self.removed = None
+
+        # milliseconds owed to NPCs that skipped ticks while far from players
+        self.owed = dict()
+        self.ticks = 0
 
     def add(self, avatar):
         self.avatars[avatar.uid] = avatar
+        self.index.insert(avatar)
+
+        if self.collisions is not None:
+            self.collisions.add(avatar)
+
+        avatar.tracker = self
+        if avatar.dirty:
+            self.dirtied.add(avatar)
+
+        if self.removed is not None:
+            self.removed.discard(avatar.uid)
+
+        if not avatar.simulated:
+            self.active.add(avatar)
 
     def remove(self, avatar):
         if avatar.uid in self.avatars:
             del self.avatars[avatar.uid]
+            self.active.discard(avatar)
+            self.asleep.pop(avatar, None)
+            self.dirtied.discard(avatar)
+            self.owed.pop(avatar.uid, None)
+            avatar.tracker = None
+
+            if self.removed is not None:
+                self.unsaved.discard(avatar)
+                self.removed.add(avatar.uid)
+
+            if avatar.simulated:
+                self.simulation.remove(avatar)
+
+        self.index.remove(avatar)
+
+        if self.collisions is not None:
+            self.collisions.remove(avatar)
+
+    def touch(self, avatar):
+        self.dirtied.add(avatar)
+
+    def sleep(self, avatar, now):
+        self.active.discard(avatar)
+
+        rest = avatar.idle()
+        alarm = None
+
+        if rest is not None:
+            alarm = next(self.alarm_ids)
+            heapq.heappush(self.alarms, (now + rest, alarm, avatar))
+
+        self.asleep[avatar] = alarm, now
+
+    def wake(self, avatar):
+        asleep = self.asleep.pop(avatar, None)
+        if asleep is None:
+            return
+
+        alarm, since = asleep
+        avatar.woken(self.now - since)
+        self.active.add(avatar)
+
+    def wake_rested(self):
+        alarms = self.alarms
+        asleep = self.asleep
+
+        while alarms and alarms[0][0] <= self.now:
+            deadline, alarm, avatar = heapq.heappop(alarms)
+
+            # woken early or gone since, the alarm is stale
+            if asleep.get(avatar, (None,))[0] == alarm:
+                self.wake(avatar)
 
     def get(self, uid):
         return self.avatars.get(uid)
@@ -153,17 +419,110 @@ class AvatarCollection(object):
     def all(self):
         return self.avatars.values()
 
-    def tick(self, delta):
-        for avatar in self.all():
-            avatar.tick(delta)
+    def tick(self, delta, near=None, stride=1):
+        """
+        With a `stride`, NPCs outside the index cells in `near` only tick
+        every `stride` ticks, catching up on the time they skipped.
+        """
+        self.ticks += 1
+        self.wake_rested()
+
+        keys = self.index.keys
+        owed = self.owed
+        end = self.now + delta
+
+        for avatar in list(self.active):
+            uid = avatar.uid
+
+            if (stride > 1 and isinstance(avatar, NPC) and
+                    keys.get(avatar) not in near and
+                    (self.ticks + hash(uid)) % stride):
+                owed[uid] = owed.get(uid, 0) + delta
+                continue
+
+            avatar.tick(delta + owed.pop(uid, 0))
+
+            if avatar.waypoint is None:
+                self.sleep(avatar, end)
+
+        self.tick_simulation(delta)
+        self.now = end
+
+    def tick_simulation(self, delta):
+        moved, turned, waypoints = self.simulation.tick(delta, Avatar.SPEED)
+        avatars = self.simulation.avatars
+
+        for slot in moved.tolist():
+            avatars[slot].mark_dirty('position')
+
+        for slot in turned.tolist():
+            avatars[slot].mark_dirty('velocity')
+
+        for slot in waypoints.tolist():
+            avatars[slot].mark_dirty('waypoint')
+
+    def resolve(self):
+        """
+        Resolve the moves made this tick and reindex whoever moved, which is
+        returned.
+        """
+        moved = self.moved()
+
+        if self.collisions is not None:
+            moved = self.collisions.resolve(moved)
+
+        for avatar in moved:
+            self.index.update(avatar)
+
+        return moved
+
+    def teleport(self, avatar, position):
+        # placed rather than moved, nothing to resolve
+        avatar.position = position
+        avatar.mark_dirty('position')
+        self.index.update(avatar)
+
+        if self.collisions is not None:
+            self.collisions.add(avatar)
+
+    def within(self, location, radius):
+        return self.index.radius(location, radius)
+
+    def rect(self, x0, y0, x1, y1):
+        return self.index.rect(x0, y0, x1, y1)
 
     def dirty(self):
-        return [a for a in self.all() if a.dirty]
+        return list(self.dirtied)
+
+    def moved(self):
+        # positions only change through dirty fields, inputs included
+        return [a for a in self.dirtied if 'position' in a.changed]
 
     def clean(self):
-        for avatar in self.all():
+        for avatar in self.dirtied:
             avatar.mark_clean()
 
+        if self.unsaved is not None:
+            self.unsaved |= self.dirtied
+
+        self.dirtied.clear()
+
+    def track_changes(self):
+        self.unsaved = set()
+        self.removed = set()
+
+    def take_changes(self):
+        """
+        The avatars changed and the uids removed since the last call, and
+        start over.  Changed avatars come in two parts, some may be in both.
+        """
+        changed = self.unsaved, list(self.dirtied)
+        removed = self.removed
+
+        self.unsaved = set()
+        self.removed = set()
+        return changed, removed
+
 
 class ChannelCollection(object):
     def __init__(self):
@@ -184,80 +543,100 @@ class ChannelCollection(object):
 
         return self.channels.get(uid)
 
-    def broadcast(self, method, *args, **kwargs):
-        for uid in self.channels:
-            method(self.channels[uid], *args, **kwargs)
-
-    def broadcast_notice(self, msg):
-        self.broadcast(Channel.send_notice, msg)
-
-    def broadcast_spawn(self, avatar):
-        self.broadcast(Channel.send_spawn, avatar)
+    def items(self):
+        return self.channels.items()
 
-    def broadcast_die(self, avatar):
-        self.broadcast(Channel.send_die, avatar)
-
-    def broadcast_update(self, avatar):
-        self.broadcast(Channel.send_update, avatar)
-
-
-class Tile(object):
-    def __init__(self, name, x, y, w, h, flags=None):
-        self.name = name
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
-        self.flags = set(flags or '')
+    def interested(self, avatar):
+        return [c for c in self.channels.values() if avatar.uid in c.interest]
 
-    def __json__(self):
-        return self.to_dict()
-
-    def to_dict(self):
-        return dict((k, v) for k, v in vars(self).items() if k != 'flags')
+    def broadcast(self, type_, data=None, channels=None,
+                  kind=OutgoingQueue.CRITICAL):
+        if channels is None:
+            channels = self.channels.values()
 
+        # encode once per protocol, every channel queues the same frame
+        msg = message(type_, data)
+        frames = {}
 
-# FIXME switch to Point for coords
-class Map(object):
-    def __init__(self, tiles, data, tile_map, tile_size=32):
-        self.tiles = tiles
-        self.data = data
-        self.tile_map = tile_map
-        self.tile_size = tile_size
+        for channel in channels:
+            protocol = channel.protocol
+            if protocol not in frames:
+                frames[protocol] = protocol.encode(msg)
 
-    @classmethod
-    def load(cls, path):
-        rv = None
+            channel.send_frame(frames[protocol], kind)
 
-        with open(path) as f:
-            obj = json.load(f)
-
-            tiles = [Tile(**i) for i in obj['tiles']]
-            data = obj['data']
-            tile_map = obj['tile_map']
+    def broadcast_notice(self, msg):
+        self.broadcast('notice', msg, kind=OutgoingQueue.DROPPABLE)
 
-            rv = cls(tiles, data, tile_map)
+    def broadcast_die(self, avatar):
+        channels = self.interested(avatar)
+        for channel in channels:
+            channel.interest.discard(avatar.uid)
+
+        self.broadcast('die', avatar.uid, channels)
+
+
+class ChannelMetrics(object):
+    """
+    Traffic of the channels writing to real sockets, counted over the ones
+    connected plus the totals of the ones that have gone away.
+    """
+
+    # (channel attribute, metric name, help)
+    COUNTERS = (
+        ('sent_bytes', 'chattr_sent_bytes_total',
+         'Bytes written to websockets'),
+        ('sent_messages', 'chattr_sent_messages_total',
+         'Messages written to websockets'),
+        ('dropped_frames', 'chattr_dropped_frames_total',
+         'Frames dropped for slow clients'),
+        ('throttled', 'chattr_throttled_messages_total',
+         'Messages dropped by client rate limits'),
+        ('malformed', 'chattr_malformed_messages_total',
+         'Client messages dropped as malformed'))
+
+    # buckets of the per channel histograms, one series per client would be
+    # too many
+    DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+    BYTES_BUCKETS = (0, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    NAMES = frozenset([name for attr, name, help in COUNTERS] +
+                      ['chattr_channel_queue_depth',
+                       'chattr_channel_queue_bytes'])
 
+    def __init__(self):
+        self.retired = dict((attr, 0) for attr, name, help in self.COUNTERS)
+
+    def retire(self, channel):
+        for attr in self.retired:
+            self.retired[attr] += getattr(channel, attr)
+
+    def collect(self, channels):
+        rv = []
+
+        for attr, name, help in self.COUNTERS:
+            counter = Counter(name, help)
+            counter.inc(self.retired[attr] +
+                        sum(getattr(c, attr) for c in channels))
+            rv.append(counter)
+
+        # distributions over the channels as of the scrape
+        depth = Histogram('chattr_channel_queue_depth',
+                          'Messages queued on each channel',
+                          buckets=self.DEPTH_BUCKETS)
+        queued = Histogram('chattr_channel_queue_bytes',
+                           'Bytes queued for writing on each channel',
+                           buckets=self.BYTES_BUCKETS)
+
+        for channel in channels:
+            depth.observe(channel.outgoing.qsize())
+            queued.observe(channel.outgoing.bytes)
+
+        rv.extend([depth, queued])
         return rv
 
-    def position(self, p):
-        return p.copy() / self.tile_size
-
-    def get(self, position):
-        x, y = self.position(position)
-        return self.tiles[self.data[y][x]]
-
-    def chunk(self, position, s):
-        x, y = self.position(position)
-        px = max(x - s / 2, 0)
-        py = max(y - s / 2, 0)
-
-        for i in range(py, py + s):
-            yield self.data[i][px:px + s]
-
 
 # FIXME make a greenlet?
-# FIXME map chunk size
 class MessageHandler(object):
 
     def __init__(self, world):
@@ -274,20 +653,47 @@ class MessageHandler(object):
 
         return handler is not None
 
+    def malformed(self, avatar, msg):
+        log.debug('dropping malformed %s from %s', msg, avatar.uid)
+
+        channel = self.world.channels.get(avatar)
+        if channel:
+            channel.malformed += 1
+
     def on_pong(self, avatar, data):
-        log.debug('ponged: %s', time.time() - data)
+        if not finite(data):
+            return self.malformed(avatar, message('pong', data))
+
+        rtt = time.time() - data
+        self.world.ping_rtt.observe(rtt)
+        log.debug('ponged: %s', rtt)
 
     def on_spawn(self, avatar, data):
         channel = self.world.channels.get(avatar)
 
         if channel:
+            visible = self.world.visible(avatar)
+            channel.interest = set(a.uid for a in visible)
+
+            # what the client needs to predict its own avatar and to
+            # interpolate everybody else between frames
+            scheduler = self.world.scheduler
+            channel.send_welcome({
+                'uid': avatar.uid,
+                'time': self.world.clock,
+                'speed': Avatar.SPEED,
+                'interval': scheduler.step * scheduler.send_interval(),
+                'chunk_size': self.world.map.CHUNK_SIZE,
+                'chunk_radius': self.world.keep_chunks + 1})
+
             channel.send_tiles(self.world.map.tiles)
-            channel.send_chunk(self.world.map.chunk(avatar.position, 50))
-            channel.send_state(self.world.avatars.all())
+            self.world.stream_chunks(channel, avatar)
+            channel.send_state(visible)
 
-        msg = 'The server welcomes avatar %s to the world!' % avatar.uid
-        self.world.channels.broadcast_notice(msg)
-        self.world.channels.broadcast_spawn(avatar)
+        # everybody else learns about the new avatar once it is in view
+        if not self.world.scheduler.essential_only():
+            msg = 'The server welcomes avatar %s to the world!' % avatar.uid
+            self.world.channels.broadcast_notice(msg)
 
     def on_die(self, avatar, data):
         self.world.channels.broadcast_die(avatar)
@@ -298,165 +704,675 @@ class MessageHandler(object):
                      'LEFT': Vector(-1, 0),
                      'RIGHT': Vector(1, 0)}
 
-        if data in input_map:
-            avatar.move(input_map.get(data))
-            avatar.mark_dirty()
+        # numbered inputs are acknowledged in frames, so the client can drop
+        # the ones it predicted that have been applied
+        seq = None
+        key = data
+        if isinstance(data, dict):
+            seq = data.get('seq')
+            key = data.get('key')
+
+        if (not isinstance(key, basestring) or
+                not (seq is None or (isinstance(seq, (int, long)) and
+                                     not isinstance(seq, bool) and
+                                     0 <= seq < 2 ** 32))):
+            return self.malformed(avatar, message('input', data))
+
+        if seq is not None:
+            avatar.input_seq = seq
+
+        if key in input_map:
+            avatar.move(input_map.get(key))
 
     # FIXME select
     def on_click(self, avatar, data):
         pass
 
     def on_dblclick(self, avatar, data):
+        if (not isinstance(data, (list, tuple)) or len(data) != 2 or
+                not all(finite(value) for value in data)):
+            return self.malformed(avatar, message('dblclick', data))
+
         x, y = data
-        avatar.set_waypoint(Vector(x, y))
+        avatar.go(Vector(x, y))
 
 
 class WorldThread(Greenlet):
-    TPS = 10.0
-    SKIP_TICKS = 1000.0 / TPS
+    # how far an avatar can see, in tiles
+    VIEW_DISTANCE = 25
 
-    def __init__(self, map):
+    # ticks between full snapshots sent to each client
+    KEYFRAME_TICKS = 50
+
+    # ticks a client may stay congested before it is disconnected
+    MAX_LAG_TICKS = 100
+
+    # messages dispatched per tick, the rest wait for the next tick, and
+    # messages that may wait at all, past that input is shed
+    MAX_MESSAGES_PER_TICK = 2000
+    MAX_QUEUED_MESSAGES = 5 * MAX_MESSAGES_PER_TICK
+
+    # messages where only the latest one from an avatar matters
+    COALESCE = ('click', 'dblclick')
+
+    PHASES = ('dispatch', 'paths', 'simulate', 'collide', 'broadcast',
+              'terrain', 'clean')
+
+    # buckets of the channel lag histogram
+    LAG_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+    # chunks a client keeps past its view, so pacing over a chunk border
+    # does not resend the same terrain
+    CHUNK_MARGIN = 1
+
+    def __init__(self, map, scheduler=None, seed=None, replayable=False):
         super(WorldThread, self).__init__()
         self.map = map
+        self.scheduler = scheduler or Scheduler()
+        self.view_radius = self.VIEW_DISTANCE * map.tile_size
+
+        # enough chunks around the avatar's to cover the view from anywhere
+        # inside its own chunk
+        self.view_chunks = -(-self.VIEW_DISTANCE // map.CHUNK_SIZE)
+        self.keep_chunks = self.view_chunks + self.CHUNK_MARGIN
+
         self.running = False
         self.ticks = 0
-        self.input = Queue(None)
-
-        self.avatars = AvatarCollection()
+        self.input = InputQueue(self.COALESCE, self.MAX_QUEUED_MESSAGES)
+
+        # world time in milliseconds since the epoch, a step per tick.  Clients
+        # interpolate by it, it stays comparable between region workers where
+        # tick numbers do not
+        self.clock = time.time() * 1000.0
+
+        # everything random in the world follows from the seed, the same
+        # seed and inputs replay the same session
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        # avatars of a world that is recorded or replayed are hashed by uid,
+        # see uid_hashed()
+        self.replayable = replayable
+
+        # logs the inputs of the world for replay.ReplayLog, when set
+        self.recorder = None
+
+        self.collisions = Collisions(map)
+        self.avatars = AvatarCollection(
+            SpatialGrid(map.tile_size),
+            simulation=Simulation(seed=self.random.getrandbits(32)),
+            collisions=self.collisions)
         self.channels = ChannelCollection()
+        self.paths = PathService(map)
         self.message_handler = MessageHandler(self)
 
         self.objects = set()
 
+        # avatars that moved in the last tick
+        self.moved = []
+
+        self.metrics = Registry()
+        self.tick_time = self.metrics.histogram(
+            'chattr_tick_seconds', 'Time spent in a world tick')
+        self.phase_times = dict(
+            (phase, self.metrics.histogram(
+                'chattr_tick_phase_seconds',
+                'Time spent in each phase of a world tick',
+                {'phase': phase}))
+            for phase in self.PHASES)
+        self.overruns = self.metrics.counter(
+            'chattr_tick_overruns_total',
+            'Ticks that ran past the start of the next tick')
+        self.tps = self.metrics.gauge(
+            'chattr_ticks_per_second', 'Measured world ticks per second')
+        self.skipped = self.metrics.counter(
+            'chattr_ticks_skipped_total',
+            'Ticks dropped when catching up would take too long')
+        self.interval = self.metrics.histogram(
+            'chattr_tick_interval_seconds',
+            'Real time between runs of the tick loop')
+        self.degradation = self.metrics.gauge(
+            'chattr_degradation_level', 'How far the world has degraded')
+        self.disconnects = self.metrics.counter(
+            'chattr_slow_disconnects_total',
+            'Clients dropped for falling too far behind')
+        self.ping_rtt = self.metrics.histogram(
+            'chattr_ping_rtt_seconds',
+            'Round trip from a ping being queued to its pong being handled')
+        self.metrics.collector(self.collect_metrics)
+
+        self.channel_metrics = ChannelMetrics()
+
+    def collect_metrics(self):
+        channels = [channel for uid, channel in self.channels.items()]
+
+        coalesced = Counter('chattr_coalesced_messages_total',
+                            'Messages superseded before being dispatched')
+        coalesced.inc(self.input.coalesced)
+
+        shed = Counter('chattr_shed_messages_total',
+                       'Messages dropped from a full input queue')
+        shed.inc(self.input.shed)
+
+        blocked = Counter('chattr_blocked_moves_total',
+                          'Moves onto blocked terrain')
+        blocked.inc(self.collisions.blocked)
+
+        contacts = Counter('chattr_avatar_contacts_total',
+                           'Avatars pushed out of another avatar')
+        contacts.inc(self.collisions.contacts)
+
+        rv = self.channel_metrics.collect(channels)
+        rv.extend([coalesced, shed, blocked, contacts])
+
+        for name, help, value in [
+                ('chattr_avatars', 'Avatars in the world',
+                 len(self.avatars.avatars)),
+                ('chattr_channels', 'Connected channels', len(channels)),
+                ('chattr_input_queue_depth',
+                 'Messages waiting for the next tick', self.input.qsize())]:
+            gauge = Gauge(name, help)
+            gauge.set(value)
+            rv.append(gauge)
+
+        lagging = Histogram('chattr_channel_lag_ticks',
+                            'Ticks each channel has been too far behind',
+                            buckets=self.LAG_BUCKETS)
+
+        for channel in channels:
+            lagging.observe(channel.lagging)
+
+        rv.append(lagging)
+        return rv
+
     def enqueue(self, avatar, msg):
-        self.input.put((avatar, msg))
+        if self.recorder:
+            self.recorder.message(self.ticks, avatar, msg)
+
+        self.input.put(avatar, msg)
 
     def incoming_messages(self):
-        try:
-            while True:
-                yield self.input.get(False)
-        except Empty:
-            pass
+        return self.input.take(self.MAX_MESSAGES_PER_TICK)
 
     def tick(self, delta):
-        for avatar, msg in self.incoming_messages():
-            self.message_handler.dispatch(avatar, msg)
-
-        self.avatars.tick(delta)
+        phases = self.phase_times
+
+        # frames carry the state as of the end of the tick
+        self.clock += delta
+
+        with self.tick_time.time():
+            with phases['dispatch'].time():
+                for avatar, msg in self.incoming_messages():
+                    # one bad message must not stop the world for everybody
+                    try:
+                        self.message_handler.dispatch(avatar, msg)
+                    except Exception:
+                        log.exception('Error dispatching %s from %s',
+                                      msg.get('type'), avatar.uid)
+                        self.message_handler.malformed(avatar, msg)
+
+            with phases['paths'].time():
+                self.paths.step()
+
+            with phases['simulate'].time():
+                stride = self.scheduler.npc_stride()
+                near = self.near_players() if stride > 1 else None
+                self.avatars.tick(delta, near, stride)
+
+            with phases['collide'].time():
+                self.moved = self.avatars.resolve()
+
+            # changes pile up until the next frame, which carries them all
+            if not self.scheduler.sending(self.ticks):
+                return
+
+            with phases['broadcast'].time():
+                self.broadcast_updates()
+
+            with phases['terrain'].time():
+                self.stream_terrain()
+
+            with phases['clean'].time():
+                self.avatars.clean()
+
+    def players(self):
+        """
+        Uids of the avatars with a client attached.
+        """
+        return [uid for uid, channel in self.channels.items()]
+
+    def near_players(self):
+        """
+        Keys of the index cells in view of some player.
+        """
+        index = self.avatars.index
+        r = self.view_radius
+        rv = set()
+
+        for uid in self.players():
+            avatar = self.avatars.get(uid)
+            if avatar:
+                p = avatar.position
+                rv.update(index.keys_in_rect(p.x - r, p.y - r, p.x + r, p.y + r))
 
-        for avatar in self.avatars.dirty():
-            self.channels.broadcast_update(avatar)
+        return rv
 
-        self.avatars.clean()
+    def visible(self, avatar):
+        return self.avatars.within(avatar.position, self.view_radius)
+
+    def broadcast_updates(self):
+        # avatars are encoded once per protocol and shared by every frame
+        snapshots = {}
+        deltas = {}
+
+        def snapshot(avatar):
+            key = protocol, avatar.uid
+            if key not in snapshots:
+                snapshots[key] = protocol.encode_snapshot(avatar)
+            return snapshots[key]
+
+        def delta(avatar):
+            key = protocol, avatar.uid
+            if key not in deltas:
+                deltas[key] = protocol.encode_delta(avatar)
+            return deltas[key]
+
+        for uid, channel in self.channels.items():
+            avatar = self.avatars.get(uid)
+            if not avatar:
+                continue
+
+            protocol = channel.protocol
+
+            # a client that is behind gets no more deltas, the pending ones
+            # are dropped and it is sent a full snapshot once it catches up
+            if channel.congested():
+                channel.lagging += 1
+                channel.dropped_frames += channel.outgoing.discard(
+                    OutgoingQueue.STATE)
+                channel.resync = True
+
+                if channel.lagging > self.MAX_LAG_TICKS:
+                    channel.close('too far behind')
+                continue
+
+            channel.lagging = 0
+
+            visible = dict((a.uid, a) for a in self.visible(avatar))
+            interest = channel.interest
+
+            full = (channel.resync or channel.keyframe is None or
+                    self.ticks - channel.keyframe >= self.KEYFRAME_TICKS)
+            channel.resync = False
+
+            spawn = []
+            update = []
+            despawn = list(interest.difference(visible))
+
+            for other in visible.itervalues():
+                if other.uid not in interest:
+                    spawn.append(snapshot(other))
+                elif full:
+                    update.append(snapshot(other))
+                elif other.dirty:
+                    update.append(delta(other))
+
+            channel.interest = set(visible)
+
+            if full:
+                channel.keyframe = self.ticks
+
+            if full or spawn or update or despawn:
+                channel.send_frame(protocol.encode_frame(self.ticks, full,
+                                                         spawn, update,
+                                                         despawn, self.clock,
+                                                         avatar.input_seq),
+                                   OutgoingQueue.STATE)
+
+    def stream_chunks(self, channel, avatar, frames=None):
+        """
+        Send the chunks coming into view as the avatar moves into a new chunk,
+        and forget the ones left far enough behind.
+        """
+        cid = self.map.chunk_id(avatar.position)
+        if cid == channel.chunk:
+            return
+
+        channel.chunk = cid
+
+        frames = {} if frames is None else frames
+        protocol = channel.protocol
+
+        for other in self.map.chunks_around(cid, self.view_chunks):
+            if other in channel.chunks:
+                continue
+
+            key = protocol, other
+            if key not in frames:
+                chunk = self.map.get_chunk(other)
+                frames[key] = protocol.encode(message('chunk', chunk))
+
+            channel.chunks.add(other)
+            channel.send_frame(frames[key])
+
+        # the client drops them as well, a chunk further out than
+        # chunk_radius in its welcome, so they are sent again on the way back
+        distance = self.map.chunk_distance
+        keep = self.keep_chunks
+        channel.chunks = set(other for other in channel.chunks
+                             if distance(cid, other) <= keep)
+
+    def stream_terrain(self):
+        # chunks are encoded once per protocol and tick
+        frames = {}
+
+        for uid, channel in self.channels.items():
+            avatar = self.avatars.get(uid)
+            if avatar:
+                self.stream_chunks(channel, avatar, frames)
 
     def _run(self):
         self.running = True
 
+        scheduler = self.scheduler
+        step = scheduler.step
+
         get_ticks = lambda: time.time() * 1000.0
-        next_tick = get_ticks()
+        last = self.clock = get_ticks()
+        lag = 0.0
 
-        next_fps = get_ticks() - 1
-        last_fps = get_ticks() - 1
-        fps_filter = 1.0
-        fps = 0.0
+        recorder = self.recorder
+        if recorder:
+            recorder.clock(self.ticks, self.clock)
+
+        next_fps = get_ticks() + 1000
+        last_fps = get_ticks()
+        last_fps_ticks = self.ticks
 
         while self.running:
-            self.tick(self.SKIP_TICKS)
-            self.ticks += 1
+            now = get_ticks()
+            self.interval.observe((now - last) / 1000.0)
+            lag += now - last
+            last = now
 
-            next_tick += self.SKIP_TICKS
+            # run the steps real time says are due, fixed size whatever the
+            # time between wake ups was
+            steps = 0
+            while lag >= step and steps < scheduler.max_catch_up:
+                start = get_ticks()
+                self.tick(step)
+                self.ticks += 1
+                elapsed = get_ticks() - start
 
-            now = get_ticks()
-            sleep_time = next_tick - now
+                if elapsed > step:
+                    self.overruns.inc()
+
+                scheduler.observe(elapsed)
+                lag -= step
+                steps += 1
+
+                if recorder:
+                    recorder.level(self.ticks, scheduler.level)
+
+            if lag >= step:
+                skipped = int(lag // step)
+                self.skipped.inc(skipped)
+                self.clock += skipped * step
+                lag -= skipped * step
 
-            if sleep_time > 0:
-                #log.debug('sleeping for %.02f', sleep_time)
-                gevent.sleep(sleep_time / 1000.0)
+                if recorder:
+                    recorder.clock(self.ticks, self.clock)
+
+            if recorder:
+                recorder.flush()
+
+            self.degradation.set(scheduler.level)
+
+            # still let the loop poll when behind, or an overloaded world
+            # starves every channel
+            now = get_ticks()
+            gevent.sleep(max(step - lag - (now - last), 1) / 1000.0)
 
             if now >= next_fps:
-                frame_fps = self.TPS * 1000 / (now - last_fps)
-                fps += ((frame_fps - fps) / fps_filter)
+                fps = (self.ticks - last_fps_ticks) * 1000 / (now - last_fps)
+                self.tps.set(fps)
 
                 #log.debug('ticks per second: %.02f', fps)
                 last_fps = now
+                last_fps_ticks = self.ticks
                 next_fps += 1000
 
+    def new_uid(self):
+        return '%032x' % self.random.getrandbits(128)
+
     def spawn(self, cls=None, args=None, kwargs=None):
-        cls = cls or Avatar
+        cls = self.avatar_class(cls or Avatar)
         args = args or ()
-        kwargs = kwargs or {}
+        kwargs = dict(kwargs or ())
+        kwargs.setdefault('uid', self.new_uid())
 
         avatar = cls(*args, **kwargs)
+        avatar.paths = self.paths
         self.avatars.add(avatar)
         self.objects.add(avatar)
-        self.enqueue(avatar, message('spawn'))
+
+        # a replayed spawn queues its own message
+        if self.recorder:
+            self.recorder.spawn(self.ticks, avatar)
+
+        self.input.put(avatar, message('spawn'), required=True)
         return avatar
 
+    def avatar_class(self, cls):
+        return uid_hashed(cls) if self.replayable else cls
+
+    def serve(self, channel):
+        """
+        Spawn an avatar for a connected channel and feed it the channel's
+        messages until the client goes away.
+        """
+        avatar = self.spawn()
+
+        self.attach(avatar, channel)
+
+        log.debug('spawned avatar %s', avatar.uid)
+
+        channel.run()
+
+        # whatever goes wrong with the client, its avatar must not outlive it
+        try:
+            while channel.is_running():
+                msg = channel.receive()
+                if not msg:
+                    break
+
+                self.enqueue(avatar, msg)
+        finally:
+            channel.wait()
+
+            self.detach(avatar)
+            self.kill(avatar)
+
+        log.debug('killed avatar %s', avatar.uid)
+
     def attach(self, avatar, channel):
         self.channels.add(avatar, channel)
 
+        if self.recorder:
+            self.recorder.attach(self.ticks, avatar)
+
     def detach(self, avatar):
+        channel = self.channels.get(avatar)
+
+        if self.recorder and channel:
+            self.recorder.detach(self.ticks, avatar)
+
+        if channel:
+            self.channel_metrics.retire(channel)
+
+            if channel.closed:
+                self.disconnects.inc()
+
         self.channels.remove(avatar)
 
     def kill(self, avatar):
+        self.paths.cancel(avatar)
         self.channels.remove(avatar)
         self.avatars.remove(avatar)
         self.objects.remove(avatar)
-        self.enqueue(avatar, message('die'))
+
+        if self.recorder:
+            self.recorder.kill(self.ticks, avatar)
+
+        self.input.put(avatar, message('die'), required=True)
 
     # FIXME - line of sight
     def inspect(self, location, radius):
-        in_range = lambda i: i.position.distance(location) < radius
-        return [i for i in self.objects if in_range(i)]
+        return self.avatars.within(location, radius)
 
 
 # FIXME limit map chunk by vision
 class Avatar(object):
-    def __init__(self):
-        self.uid = uuid.uuid4().hex
-        self.size = random.randint(5, 20)
-        self.position = Vector(random.randint(0, 640), random.randint(0, 640))
+    # fields sent to clients, deltas only carry the ones that changed
+    FIELDS = ('uid', 'size', 'position', 'velocity', 'rotation', 'waypoint')
+
+    # pixels per millisecond when heading for a waypoint
+    SPEED = 0.01
+
+    # finds paths for go(), set when spawned in a world
+    paths = None
+
+    # waypoints left to visit after the current one
+    path = ()
+
+    # the collection tracking changes to the avatar, set when added to one
+    tracker = None
+
+    # sequence number of the last numbered input applied
+    input_seq = 0
+
+    # moved by a Simulation instead of ticking itself
+    simulated = False
+
+    def __init__(self, uid=None):
+        self.uid = uid or uuid.uuid4().hex
+        self.rng = Rng(int(self.uid, 16))
+        self.size = self.rng.randint(5, 20)
+        self.position = Vector(self.rng.randint(0, 640),
+                               self.rng.randint(0, 640))
         self.velocity = Vector()
         self.rotation = 0
-        self.dirty = True
+        self.changed = set(self.FIELDS)
         self.ticks = 0
         self.waypoint = None
 
     def __json__(self):
         return self.stat()
 
-    def mark_dirty(self):
-        self.dirty = True
+    def uid_hash(self):
+        # the __hash__ of the classes made by uid_hashed()
+        return hash(self.uid)
+
+    @property
+    def dirty(self):
+        return bool(self.changed)
+
+    def mark_dirty(self, *fields):
+        self.changed.update(fields or self.FIELDS)
+
+        if self.tracker is not None:
+            self.tracker.touch(self)
 
     def mark_clean(self):
-        self.dirty = False
+        self.changed.clear()
+
+    def idle(self):
+        """
+        Milliseconds until an avatar with nowhere to go has something to do
+        again, None when only being given a waypoint will do.
+        """
+        return None
+
+    def woken(self, slept):
+        pass
 
     def set_waypoint(self, vec):
         self.waypoint = vec
+        self.mark_dirty('waypoint')
+
+        if self.tracker is not None:
+            self.tracker.wake(self)
+
+    def stop(self):
+        self.path = ()
+        self.waypoint = None
+        self.velocity = Vector()
+        self.mark_dirty('velocity', 'waypoint')
+
+    def follow(self, waypoints):
+        self.path = deque(waypoints[1:])
+        self.set_waypoint(waypoints[0])
+
+    def go(self, goal):
+        """
+        Head for `goal` around whatever is in the way, once a path is found.
+        """
+        if self.paths is None:
+            self.set_waypoint(goal)
+        else:
+            self.paths.request(self, goal)
+
+    @staticmethod
+    def pack(value):
+        # sub-pixel precision is plenty for the client
+        if isinstance(value, Vector):
+            return [round(value.x, 2), round(value.y, 2)]
+
+        return value
+
+    def field(self, name):
+        return self.pack(getattr(self, name))
+
+    def update(self, name, value):
+        changed = self.field(name) != self.pack(value)
+        setattr(self, name, value)
+
+        if changed:
+            self.mark_dirty(name)
 
     def stat(self):
-        exclude = ('ticks', 'dirty')
-        return dict((k, v) for k, v in vars(self).items() if k not in exclude)
+        return dict((k, self.field(k)) for k in self.FIELDS)
+
+    def delta(self):
+        rv = dict((k, self.field(k)) for k in self.changed)
+        rv['uid'] = self.uid
+        return rv
 
     def move(self, vec):
         self.position += vec
+        self.mark_dirty('position')
 
     def tick(self, delta):
         self.ticks += 1
 
         if self.waypoint:
-            dist_to_waypoint = self.position.distance(self.waypoint)
+            step = self.SPEED * delta
+            arrived = self.position.within(self.waypoint, step)
 
-            if dist_to_waypoint <= 1:
+            if arrived and self.path:
                 self.position = self.waypoint
-                self.velocity.zero()
-                self.waypoint = None
-            elif dist_to_waypoint > 1:
-                self.velocity = (self.waypoint - self.position).normalize()
-
-            self.position += self.velocity
+                self.set_waypoint(self.path.popleft())
+            elif arrived:
+                self.position = self.waypoint
+                self.stop()
+            else:
+                self.update('velocity',
+                            (self.waypoint - self.position).normalize())
 
-            self.mark_dirty()
+            self.position.add_scaled(self.velocity, step)
+            self.mark_dirty('position')
 
 
 class NPC(Avatar):
@@ -464,60 +1380,134 @@ class NPC(Avatar):
 
 
 class Wanderer(NPC):
-    def __init__(self, range):
-        super(Wanderer, self).__init__()
+    def __init__(self, range, **kwargs):
+        super(Wanderer, self).__init__(**kwargs)
         self.range = range
         self.rest = 0
 
+    def idle(self):
+        # it rested through the tick that put it to sleep already
+        return max(self.rest, 0)
+
+    def woken(self, slept):
+        self.rest -= slept
+
     def tick(self, delta):
 
         if not self.waypoint:
             if self.rest <= 0:
-                tmp = Vector(random.randint(-self.range, self.range),
-                             random.randint(-self.range, self.range))
-                self.waypoint = self.position + tmp
-                self.rest = random.randint(1500, 3000)
+                rng = self.rng
+                tmp = Vector(rng.randint(-self.range, self.range),
+                             rng.randint(-self.range, self.range))
+                self.go(self.position + tmp)
+                self.rest = rng.randint(1500, 3000)
             else:
                 self.rest -= delta
 
         super(Wanderer, self).tick(delta)
 
 
-World = WorldThread(Map.load('map.json'))
+def simulated_vector(name):
+    def get(self):
+        x, y = getattr(self.simulation, name)[self.slot]
+        return Vector(float(x), float(y))
 
+    def set(self, vec):
+        getattr(self.simulation, name)[self.slot] = tuple(vec)
 
-@view_config(route_name='endpoint', renderer='string')
-def endpoint(request):
-    avatar = World.spawn()
-    channel = Channel(request.environ['wsgi.websocket'])
+    return property(get, set)
+
+
+def simulated_value(name):
+    def get(self):
+        return float(getattr(self.simulation, name)[self.slot])
+
+    def set(self, value):
+        getattr(self.simulation, name)[self.slot] = value
+
+    return property(get, set)
 
-    World.attach(avatar, channel)
 
-    log.debug('spawned avatar %s', avatar.uid)
+class SimulatedWanderer(Wanderer):
+    """
+    A Wanderer that is only a view on its slot in a Simulation, which moves
+    all of them at once.
+    """
+    simulated = True
 
-    channel.run()
+    def __init__(self, simulation, range, **kwargs):
+        self.simulation = simulation
+        self.slot = simulation.add(self)
+        super(SimulatedWanderer, self).__init__(range, **kwargs)
 
-    while channel.is_running:
-        msg = channel.receive()
-        if not msg:
-            break
+    position = simulated_vector('position')
+    velocity = simulated_vector('velocity')
+    rest = simulated_value('rest')
+    range = simulated_value('range')
 
-        World.enqueue(avatar, msg)
+    @property
+    def waypoint(self):
+        if self.simulation.has_waypoint[self.slot]:
+            x, y = self.simulation.waypoint[self.slot]
+            return Vector(float(x), float(y))
 
-    channel.wait()
+    @waypoint.setter
+    def waypoint(self, vec):
+        self.simulation.has_waypoint[self.slot] = vec is not None
+        if vec is not None:
+            self.simulation.waypoint[self.slot] = tuple(vec)
 
-    World.detach(avatar)
-    World.kill(avatar)
+    def tick(self, delta):
+        pass
+
+
+# uid hashed subclasses of the avatar classes, by class
+UID_HASHED = {}
+
+
+def uid_hashed(cls):
+    """
+    A subclass of `cls` hashing its avatars by uid instead of by address, so
+    that sets of them iterate in the same order every time a world runs.  It
+    keeps the name of `cls`.  Costs about a third of a crowded tick, which
+    is why only worlds that are recorded or replayed use it.
+    """
+    if cls not in UID_HASHED:
+        UID_HASHED[cls] = type(cls.__name__, (cls,),
+                               {'__hash__': Avatar.uid_hash,
+                                '__module__': cls.__module__})
+
+    return UID_HASHED[cls]
+
+
+Connections = ConnectionManager()
+
+# created by main() once the map named in the settings is loaded
+World = None
+
+
+def endpoint(request):
+    channel = Channel(request.environ['wsgi.websocket'],
+                      negotiate(request.params.get('protocol')))
+
+    World.serve(channel)
+
+
+def metrics(request):
+    from pyramid.response import Response
 
-    log.debug('killed avatar %s', avatar.uid)
+    return Response(World.metrics.render(),
+                    content_type='text/plain; version=0.0.4')
 
 
-@view_config(route_name='root', renderer='/base.mako')
 def root(request):
     return {}
 
 
 def server_factory(global_conf, host, port):
+    from gevent.pywsgi import WSGIServer
+    from geventwebsocket import WebSocketHandler
+
     port = int(port)
 
     def serve(app):
@@ -529,22 +1519,78 @@ def server_factory(global_conf, host, port):
 
 
 def main(global_config, **settings):
+    global World
 
     signal.signal(signal.SIGUSR2,
                   lambda sig, frame: code.interact(local=globals()))
 
+    from pyramid.config import Configurator
+
     config = Configurator(settings=settings)
     config.add_static_view('static', 'chattr:static')
 
     config.add_route('root', '/')
     config.add_route('endpoint', '/end-point')
+    config.add_route('metrics', '/metrics')
+
+    config.add_view(root, route_name='root', renderer='/base.mako')
+    config.add_view(endpoint, route_name='endpoint', renderer='string')
+    config.add_view(metrics, route_name='metrics')
+
+    log.info('Loading the map')
+    map = Map.load(settings.get('chattr.map', 'map.json'))
+
+    columns, rows = [int(n) for n in
+                     settings.get('chattr.regions', '1x1').split('x')]
+    wanderers = int(settings.get('chattr.wanderers', 20))
+    simulation = settings.get('chattr.simulation', 'object')
+
+    from chattr.replay import ReplayLog
+    from chattr.snapshot import Snapshots
+    recorder = ReplayLog.from_settings(settings)
+    snapshots = Snapshots.from_settings(settings)
+
+    if columns * rows > 1:
+        from chattr.shard import ShardedWorld
+
+        if recorder:
+            log.warning('Replay logs are only recorded for a single world')
 
-    config.scan()
+        log.info('Starting %d region workers', columns * rows)
+        World = ShardedWorld(map, columns, rows,
+                             Scheduler.from_settings(settings), snapshots)
+        World.start()
+
+        # regions restored from a snapshot keep the NPCs they had
+        World.spawn_npcs(wanderers, simulation)
+
+        return config.make_wsgi_app()
+
+    World = WorldThread(map, Scheduler.from_settings(settings),
+                        replayable=recorder is not None)
+
+    restored = 0
+    if snapshots:
+        log.info('Restoring the world')
+        restored = snapshots.restore(World)
+
+    if recorder:
+        recorder.start(World)
 
     log.info('Starting the world')
     World.start()
 
-    for i in range(20):
-        World.spawn(Wanderer, args=(100,))
+    if snapshots:
+        snapshots.start(World)
+
+    if restored:
+        return config.make_wsgi_app()
+
+    for i in range(wanderers):
+        if simulation == 'array':
+            World.spawn(SimulatedWanderer,
+                        args=(World.avatars.simulation, 100))
+        else:
+            World.spawn(Wanderer, args=(100,))
 
     return config.make_wsgi_app()
@@ -0,0 +1,154 @@
+# -----------------------------------------------------------------------------
+#
+# Movement resolution
+#
+# Avatars move freely while they tick, the world then resolves the moves of
+# everybody that moved in one pass:
+#
+#   terrain   an avatar that stepped onto a blocked tile slides along it when
+#             one axis of the step is clear, otherwise it is put back where
+#             it was and stops
+#
+#   avatars   an avatar that overlaps another is pushed out along the line
+#             between their centers, half way when both of them moved
+#
+# Bodies are bucketed in their own grid of small cells, so an avatar is only
+# tested against the few others in the cells around it and a tick costs about
+# the number of avatars that moved, however dense the crowd.
+# -----------------------------------------------------------------------------
+
+import math
+
+from chattr.spatial import SpatialGrid
+from chattr.vector import Vector
+
+
+class Collisions(object):
+    def __init__(self, map, cell_tiles=2):
+        self.map = map
+        self.grid = SpatialGrid(map.tile_size, cell_tiles)
+
+        # where each avatar was left by the last resolution
+        self.resolved = dict()
+
+        # how far around an avatar another one can touch it
+        self.largest = 0
+
+        self.blocked = 0
+        self.contacts = 0
+
+    def __len__(self):
+        return len(self.resolved)
+
+    def add(self, avatar):
+        p = avatar.position
+        self.resolved[avatar] = p.x, p.y
+        self.largest = max(self.largest, avatar.size)
+        self.grid.update(avatar)
+
+    def remove(self, avatar):
+        self.resolved.pop(avatar, None)
+        self.grid.remove(avatar)
+
+    def resolve(self, avatars):
+        """
+        Resolve the moves of `avatars`, the ones that may have moved since the
+        last resolution.  Returns those that did.
+        """
+        resolved = self.resolved
+        grid = self.grid
+        moved = []
+
+        for avatar in avatars:
+            last = resolved.get(avatar)
+            if last is None:
+                continue
+
+            p = avatar.position
+            if (p.x, p.y) == last:
+                continue
+
+            p = self.terrain(avatar, p, last)
+            resolved[avatar] = p.x, p.y
+            grid.update(avatar)
+            moved.append(avatar)
+
+        movers = set(moved)
+        for avatar in moved:
+            if self.separate(avatar, movers):
+                grid.update(avatar)
+
+        return moved
+
+    def terrain(self, avatar, p, last):
+        """
+        Where the avatar ends up after its step from `last` to `p`.
+        """
+        passable = self.map.passable
+        x0, y0 = last
+
+        # something stuck in blocked terrain is let walk out of it
+        if passable(p) or not passable(Vector(x0, y0)):
+            return p
+
+        self.blocked += 1
+
+        for x, y in ((p.x, y0), (x0, p.y)):
+            slide = Vector(x, y)
+            if passable(slide):
+                avatar.position = slide
+                return slide
+
+        avatar.position = p = Vector(x0, y0)
+        avatar.stop()
+        return p
+
+    def separate(self, avatar, movers):
+        # positions are read from `resolved`, a simulated avatar's position
+        # is slow to get at
+        resolved = self.resolved
+        x, y = resolved[avatar]
+        size = avatar.size
+        r = size + self.largest
+        pushed = False
+
+        for cell in self.grid.cells_in_rect(x - r, y - r, x + r, y + r):
+            for other in cell:
+                if other is avatar:
+                    continue
+
+                ox, oy = resolved[other]
+                dx, dy = x - ox, y - oy
+                reach = size + other.size
+
+                d2 = dx * dx + dy * dy
+                if d2 >= reach * reach:
+                    continue
+
+                # stacked exactly on top of each other, part them along x
+                if d2 == 0:
+                    dx, dy, d = 1.0, 0.0, 1.0
+                else:
+                    d = math.sqrt(d2)
+
+                push = reach - d
+                if other in movers:
+                    push /= 2.0
+
+                x += dx / d * push
+                y += dy / d * push
+                pushed = True
+
+        if not pushed:
+            return False
+
+        self.contacts += 1
+
+        target = Vector(x, y)
+        if not self.map.passable(target):
+            return False
+
+        avatar.position = target
+        avatar.mark_dirty('position')
+        resolved[avatar] = x, y
+        return True
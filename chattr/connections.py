@@ -0,0 +1,208 @@
+# -----------------------------------------------------------------------------
+#
+# Connection manager
+#
+# Channels only run a reader greenlet of their own.  Pings for every channel
+# are scheduled on one timer wheel, and frames are written by a small pool of
+# writer greenlets: a channel with queued frames is put on a ready list and
+# the next free writer drains its whole queue onto the socket in one go.
+#
+# Writers never wait on a socket that is not writable.  A channel whose
+# socket's send buffer is full is parked instead: a greenlet of its own waits
+# for the socket to drain and puts it back on the ready list, while frames
+# pile up in its queue and the world's backpressure takes over.  A socket
+# that stays full for WRITE_TIMEOUT, or stalls for SEND_TIMEOUT in the middle
+# of a frame, gets its channel closed.
+# -----------------------------------------------------------------------------
+
+from gevent.event import Event
+from gevent.socket import wait_write
+import gevent
+
+from geventwebsocket import WebSocketError
+
+from collections import deque
+import logging
+import select
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel, `slots` buckets of `resolution` seconds.  Timers
+    further out than one turn of the wheel count down the turns left.
+    """
+
+    def __init__(self, resolution=0.1, slots=512):
+        self.resolution = resolution
+        self.slots = [[] for i in range(slots)]
+        self.cursor = 0
+
+    def schedule(self, item, delay):
+        ticks = max(int(round(delay / self.resolution)), 1) - 1
+        rounds, offset = divmod(ticks, len(self.slots))
+
+        slot = (self.cursor + 1 + offset) % len(self.slots)
+        self.slots[slot].append((rounds, item))
+
+    def advance(self):
+        """
+        Move to the next slot and return the items that came due.
+        """
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+        due = []
+        waiting = []
+        for rounds, item in self.slots[self.cursor]:
+            if rounds:
+                waiting.append((rounds - 1, item))
+            else:
+                due.append(item)
+
+        self.slots[self.cursor] = waiting
+        return due
+
+
+class ConnectionManager(object):
+    WRITERS = 8
+
+    # seconds a parked socket may stay full, and a writer may spend on one
+    # frame, a frame once started can not be abandoned without breaking the
+    # stream
+    WRITE_TIMEOUT = 5
+    SEND_TIMEOUT = 0.5
+
+    def __init__(self, writers=WRITERS, resolution=0.1):
+        self.channels = set()
+        self.wheel = TimerWheel(resolution)
+
+        # channels with frames waiting for a writer
+        self.ready = deque()
+        self.pending = set()
+        self.wakeup = Event()
+
+        self.writers = writers
+        self.greenlets = []
+
+    def start(self):
+        if self.greenlets:
+            return
+
+        self.greenlets = ([gevent.spawn(self.do_ping)] +
+                          [gevent.spawn(self.do_write)
+                           for i in range(self.writers)])
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.greenlets = []
+
+    def add(self, channel):
+        self.start()
+        self.channels.add(channel)
+        self.wheel.schedule(channel, channel.ping_interval)
+
+    def remove(self, channel):
+        # its ping timer is dropped when it comes due
+        self.channels.discard(channel)
+
+    def wake(self, channel):
+        if channel in self.pending:
+            return
+
+        self.start()
+        self.pending.add(channel)
+        self.ready.append(channel)
+        self.wakeup.set()
+
+    def do_ping(self):
+        wheel = self.wheel
+        last = time.time()
+
+        while True:
+            gevent.sleep(wheel.resolution)
+
+            now = time.time()
+            steps = int((now - last) / wheel.resolution)
+            last += steps * wheel.resolution
+
+            for i in xrange(steps):
+                for channel in wheel.advance():
+                    if channel in self.channels and channel.running:
+                        channel.send_ping()
+                        wheel.schedule(channel, channel.ping_interval)
+
+    def do_write(self):
+        while True:
+            while not self.ready:
+                self.wakeup.clear()
+                self.wakeup.wait()
+
+            channel = self.ready.popleft()
+            parked = False
+            try:
+                parked = self.write(channel)
+            finally:
+                # a parked channel stays pending until its socket drains
+                if not parked:
+                    self.pending.discard(channel)
+
+    @staticmethod
+    def writable(sock):
+        # fake sockets, as in the load test, always are
+        if sock is None:
+            return True
+
+        r, w, x = select.select([], [sock], [], 0)
+        return bool(w)
+
+    def write(self, channel):
+        """
+        Write out the channel's queued frames for as long as its socket takes
+        them.  Returns True when the channel was parked with frames left.
+        """
+        outgoing = channel.outgoing
+        send = channel.socket.send
+        sock = getattr(channel.socket, 'socket', None)
+
+        if channel.closed:
+            outgoing.clear()
+            return False
+
+        try:
+            while not outgoing.empty():
+                if not self.writable(sock):
+                    gevent.spawn(self.park, channel, sock)
+                    return True
+
+                frame = outgoing.pop()
+                with gevent.Timeout(self.SEND_TIMEOUT):
+                    send(frame)
+
+                channel.sent_bytes += len(frame)
+                channel.sent_messages += 1
+        except gevent.Timeout:
+            channel.close('write timed out')
+        except (WebSocketError, socket.error), e:
+            log.error('Error sending on websocket: %s', e)
+            channel.running = False
+            outgoing.clear()
+            channel.shutdown()
+
+        return False
+
+    def park(self, channel, sock):
+        try:
+            wait_write(sock.fileno(), timeout=self.WRITE_TIMEOUT)
+        except socket.timeout:
+            channel.close('write timed out')
+        except (socket.error, ValueError):
+            # closed under us
+            pass
+
+        self.pending.discard(channel)
+
+        if not channel.closed and channel.running:
+            self.wake(channel)
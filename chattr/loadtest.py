@@ -0,0 +1,237 @@
+# -----------------------------------------------------------------------------
+#
+# Headless load test
+#
+# Runs a world and N simulated clients in one process.  Clients talk to the
+# world through the same Channel and WorldThread.serve code path as real
+# websockets, over a fake socket, sending input and dblclick messages at
+# configurable rates.  Client behaviour is seeded so runs are repeatable.
+#
+#   python -m chattr.loadtest --clients 200 --duration 30
+#
+# Latencies are measured from pings: delivery is the time from the server
+# queueing a ping to the client reading it, round trip is measured by the
+# server when the pong is dispatched in a tick.  CPU is for the whole process,
+# simulated clients included.
+# -----------------------------------------------------------------------------
+
+from gevent.queue import Queue
+import gevent
+
+import argparse
+import json
+import random
+import resource
+import time
+
+from chattr import (Channel, Map, SimulatedWanderer, Wanderer, WorldThread,
+                    flatten_message, message, negotiate, parse_message)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class FakeSocket(object):
+    """
+    Stands in for a websocket, Channel only needs receive and send.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.inbox = Queue(None)
+
+    def receive(self):
+        return self.inbox.get()
+
+    def send(self, frame):
+        self.client.handle(frame)
+
+    def close(self):
+        self.inbox.put(None)
+
+
+class Stats(object):
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.sent = 0
+        self.delivery = []
+
+
+class SimulatedClient(object):
+    INPUTS = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+
+    def __init__(self, world, stats, rng, protocol='json', input_rate=2.0,
+                 dblclick_rate=0.2, ping_interval=1.0):
+        self.world = world
+        self.stats = stats
+        self.rng = rng
+        self.input_rate = input_rate
+        self.dblclick_rate = dblclick_rate
+
+        self.socket = FakeSocket(self)
+        self.channel = Channel(self.socket, negotiate(protocol))
+        self.channel.ping_interval = ping_interval
+
+    def handle(self, frame):
+        self.stats.messages += 1
+        self.stats.bytes += len(frame)
+
+        # binary frames only carry state, pings are always json
+        if isinstance(frame, bytearray):
+            return
+
+        msg = parse_message(frame)
+        if msg['type'] == 'ping':
+            self.stats.delivery.append(time.time() - msg['data'])
+            self.send('pong', msg['data'])
+
+    def send(self, type_, data):
+        self.stats.sent += 1
+        self.socket.inbox.put(flatten_message(message(type_, data)))
+
+    def next_event(self):
+        rate = self.input_rate + self.dblclick_rate
+        wait = self.rng.expovariate(rate)
+
+        if self.rng.random() * rate < self.input_rate:
+            return wait, 'input', self.rng.choice(self.INPUTS)
+
+        size = self.world.map.tile_size
+        return wait, 'dblclick', [self.rng.randint(0, self.world.map.width * size),
+                                  self.rng.randint(0, self.world.map.height * size)]
+
+    def run(self, duration):
+        server = gevent.spawn(self.world.serve, self.channel)
+
+        deadline = time.time() + duration
+        while True:
+            wait, type_, data = self.next_event()
+            if time.time() + wait >= deadline:
+                break
+
+            gevent.sleep(wait)
+            self.send(type_, data)
+
+        gevent.sleep(max(deadline - time.time(), 0))
+
+        self.socket.close()
+        server.join()
+
+
+def run(world, clients=100, duration=30.0, seed=0, **kwargs):
+    rng = random.Random(seed)
+    stats = Stats()
+
+    simulated = [SimulatedClient(world, stats, random.Random(rng.random()),
+                                 **kwargs)
+                 for i in range(clients)]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    ticks = world.ticks
+    overruns = world.overruns.value
+    tick_time = world.tick_time.sum, world.tick_time.count
+    start = time.time()
+
+    gevent.joinall([gevent.spawn(c.run, duration) for c in simulated])
+
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    ticks = world.ticks - ticks
+    tick_count = world.tick_time.count - tick_time[1]
+    tick_sum = world.tick_time.sum - tick_time[0]
+
+    ms = lambda s: round(s * 1000, 3)
+
+    return {
+        'clients': clients,
+        'duration': round(elapsed, 3),
+        'ticks': ticks,
+        'ticks_per_second': round(ticks / elapsed, 2),
+        'tick_mean_ms': ms(tick_sum / tick_count if tick_count else 0),
+        'tick_overruns': world.overruns.value - overruns,
+        'cpu_percent': round((usage.ru_utime + usage.ru_stime - cpu) /
+                             elapsed * 100, 1),
+        'client_messages_sent': stats.sent,
+        'server_messages_sent': stats.messages,
+        'server_bytes_sent': stats.bytes,
+        'server_bytes_per_client_second': round(stats.bytes / elapsed /
+                                                max(clients, 1), 1),
+        'ping_delivery_p50_ms': ms(percentile(stats.delivery, 50)),
+        'ping_delivery_p99_ms': ms(percentile(stats.delivery, 99)),
+        'ping_delivery_max_ms': ms(max(stats.delivery or [0])),
+        'ping_rtt_mean_ms': ms(world.ping_rtt.sum / world.ping_rtt.count
+                               if world.ping_rtt.count else 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a chattr world')
+    parser.add_argument('--map', default='map.json')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--protocol', default='json',
+                        choices=('json', 'binary'))
+    parser.add_argument('--input-rate', type=float, default=2.0,
+                        help='input messages per client per second')
+    parser.add_argument('--dblclick-rate', type=float, default=0.2,
+                        help='dblclick messages per client per second')
+    parser.add_argument('--ping-interval', type=float, default=1.0)
+    parser.add_argument('--wanderers', type=int, default=20)
+    parser.add_argument('--simulation', default='object',
+                        choices=('object', 'array'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', default=None,
+                        help='record a replay log of the run to this file')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    recorder = None
+    if args.record:
+        from chattr.replay import ReplayLog
+        recorder = ReplayLog(args.record)
+
+    world = WorldThread(Map.load(args.map), seed=args.seed,
+                        replayable=recorder is not None)
+
+    if recorder:
+        recorder.start(world)
+
+    for i in range(args.wanderers):
+        if args.simulation == 'array':
+            world.spawn(SimulatedWanderer,
+                        args=(world.avatars.simulation, 100))
+        else:
+            world.spawn(Wanderer, args=(100,))
+
+    world.start()
+
+    report = run(world, args.clients, args.duration, args.seed,
+                 protocol=args.protocol,
+                 input_rate=args.input_rate,
+                 dblclick_rate=args.dblclick_rate,
+                 ping_interval=args.ping_interval)
+
+    world.running = False
+    world.join()
+
+    if recorder:
+        recorder.stop()
+
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        for key in sorted(report):
+            print '%-32s %s' % (key, report[key])
+
+if __name__ == '__main__':
+    main()
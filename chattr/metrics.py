@@ -0,0 +1,148 @@
+# -----------------------------------------------------------------------------
+#
+# Server metrics, rendered in the Prometheus text exposition format
+#
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# -----------------------------------------------------------------------------
+
+from contextlib import contextmanager
+import time
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    pairs = ('%s="%s"' % (k, str(v).replace('"', '\\"'))
+             for k, v in sorted(labels.items()))
+    return '{%s}' % ','.join(pairs)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+    def __init__(self, name, help, labels=None, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield (self.name + '_bucket', dict(self.labels, le=le), total)
+
+        yield self.name + '_sum', self.labels, self.sum
+        yield self.name + '_count', self.labels, self.count
+
+
+class Registry(object):
+    """
+    A set of metrics plus collectors, callables returning metrics built at
+    scrape time for values that are cheaper to read than to keep updated.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=None):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=None, **kwargs):
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def collect(self):
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        # metrics sharing a name are rendered together under one header
+        metrics = self.collect()
+        names = []
+        for metric in metrics:
+            if metric.name not in seen:
+                seen.add(metric.name)
+                names.append(metric.name)
+
+        for name in names:
+            group = [m for m in metrics if m.name == name]
+            lines.append('# HELP %s %s' % (name, group[0].help))
+            lines.append('# TYPE %s %s' % (name, group[0].type))
+
+            for metric in group:
+                for sample, labels, value in metric.samples():
+                    lines.append('%s%s %s' % (sample, format_labels(labels),
+                                              format_value(value)))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,458 @@
+# -----------------------------------------------------------------------------
+#
+# Pathfinding
+#
+# A* over the tile grid, eight way without cutting corners, on passability
+# derived from the tiles' flags.  Long routes are planned in two levels: a
+# search over the map's chunks, linked where some pair of passable tiles
+# crosses their shared border, picks a corridor of chunks and the tile search
+# is confined to it.  Chunk links over approximate tile connectivity, so when
+# the chunks can't connect the tiles can't either, and when the corridor
+# turns out to be a dead end the tile search is rerun over the whole map.
+#
+# Searches are incremental, PathService steps them each tick within a budget
+# of expanded nodes so many requests at once can't stall a tick.  Results are
+# kept in an LRU cache keyed by start and goal tile.
+# -----------------------------------------------------------------------------
+
+from collections import OrderedDict, deque
+import heapq
+import math
+import numpy
+
+from chattr.vector import Vector
+
+# tile flag marking tiles nothing can walk on
+BLOCKED = 'b'
+
+SQRT2 = math.sqrt(2)
+INF = float('inf')
+
+
+def straighten(path):
+    """
+    Drop the tiles in the middle of straight runs, keeping the turns.
+    """
+    if len(path) < 3:
+        return list(path)
+
+    rv = [path[0]]
+    for prev, tile, next in zip(path, path[1:], path[2:]):
+        if (tile[0] - prev[0], tile[1] - prev[1]) != (next[0] - tile[0],
+                                                      next[1] - tile[1]):
+            rv.append(tile)
+
+    rv.append(path[-1])
+    return rv
+
+
+class PathSearch(object):
+    """
+    One A* search from tile `start` to tile `goal`, run a few nodes at a time
+    by step().  Once `done`, `path` is the list of tiles or None.
+
+    Nodes are indexes into the pathfinder's padded grid, whose blocked border
+    saves bounds checks.
+    """
+
+    def __init__(self, pathfinder, start, goal, max_nodes=None):
+        self.pathfinder = pathfinder
+        self.start = pathfinder.clamp(*start)
+        self.goal = goal
+        self.max_nodes = max_nodes or pathfinder.MAX_NODES
+
+        self.done = False
+        self.path = None
+        self.expanded = 0
+        self.corridor = None
+
+        if not pathfinder.passable_at(*goal):
+            self.done = True
+            return
+
+        corridor = pathfinder.corridor(self.start, goal)
+        if corridor == ():
+            self.done = True
+            return
+
+        if corridor is not None:
+            self.corridor = bytearray(pathfinder.chunks_wide *
+                                      pathfinder.chunks_tall)
+            for cid in corridor:
+                self.corridor[cid] = 1
+
+        self.reset()
+
+    def reset(self):
+        node = self.pathfinder.node(*self.start)
+        self.open = [(0.0, 0.0, node)]
+        self.costs = {node: 0.0}
+        self.parents = {node: None}
+        self.closed = set()
+
+    def step(self, budget):
+        """
+        Expand up to `budget` nodes, returns how many were expanded.
+        """
+        if self.done:
+            return 0
+
+        pathfinder = self.pathfinder
+        grid = pathfinder.grid
+        stride = pathfinder.stride
+        size = pathfinder.chunk_size
+        chunks_wide = pathfinder.chunks_wide
+        corridor = self.corridor
+        neighbours = pathfinder.neighbours
+        heappush, heappop = heapq.heappush, heapq.heappop
+
+        open, costs, parents, closed = (self.open, self.costs, self.parents,
+                                        self.closed)
+        gx, gy = self.goal
+        goal = pathfinder.node(gx, gy)
+        diagonal = SQRT2 - 1
+        n = 0
+
+        while n < budget:
+            if not open or self.expanded >= self.max_nodes:
+                if corridor is not None and open == []:
+                    # the corridor was a dead end, search everywhere
+                    corridor = self.corridor = None
+                    self.reset()
+                    open, costs, parents, closed = (self.open, self.costs,
+                                                    self.parents, self.closed)
+                    continue
+
+                self.done = True
+                break
+
+            f, cost, node = heappop(open)
+            if node in closed:
+                continue
+
+            if node == goal:
+                self.path = self.trace(node)
+                self.done = True
+                break
+
+            closed.add(node)
+            n += 1
+            self.expanded += 1
+
+            for offset, step, a, b in neighbours:
+                neighbour = node + offset
+
+                # no squeezing diagonally between two blocked tiles
+                if (not grid[neighbour] or neighbour in closed or
+                        (a and not (grid[node + a] and grid[node + b]))):
+                    continue
+
+                y, x = divmod(neighbour, stride)
+                x -= 1
+                y -= 1
+
+                if (corridor is not None and
+                        not corridor[(y // size) * chunks_wide + x // size]):
+                    continue
+
+                g = cost + step
+                if g < costs.get(neighbour, INF):
+                    costs[neighbour] = g
+                    parents[neighbour] = node
+
+                    dx = abs(x - gx)
+                    dy = abs(y - gy)
+                    h = dx + dy + diagonal * min(dx, dy) - min(dx, dy)
+                    heappush(open, (g + h, g, neighbour))
+
+        return n
+
+    def trace(self, node):
+        rv = []
+        parents = self.parents
+        stride = self.pathfinder.stride
+
+        while node is not None:
+            y, x = divmod(node, stride)
+            rv.append((x - 1, y - 1))
+            node = parents[node]
+
+        rv.reverse()
+        return rv
+
+    def run(self):
+        while not self.done:
+            self.step(self.max_nodes)
+
+        return self.path
+
+
+class Pathfinder(object):
+    # tile searches give up after expanding this many nodes
+    MAX_NODES = 20000
+
+    # routes between chunks further apart than this are planned over chunks
+    # first
+    CORRIDOR_DISTANCE = 2
+
+    def __init__(self, map, cache_size=1024):
+        self.map = map
+        self.tile_size = map.tile_size
+        self.chunk_size = map.CHUNK_SIZE
+        self.chunks_wide = map.chunks_wide
+        self.chunks_tall = map.chunks_tall
+
+        self.passable = self.build_passable(map)
+        self.east, self.south = self.build_links()
+
+        # row major copy with a blocked border, indexing a bytearray is much
+        # cheaper than numpy
+        height, width = self.passable.shape
+        self.stride = width + 2
+
+        padded = numpy.zeros((height + 2, width + 2), dtype=bool)
+        padded[1:-1, 1:-1] = self.passable
+        self.grid = bytearray(padded.tostring())
+
+        # offsets to the eight neighbours, their cost and for diagonals the
+        # two orthogonal neighbours that must be open
+        w = self.stride
+        self.neighbours = ((1, 1.0, 0, 0), (-1, 1.0, 0, 0),
+                           (w, 1.0, 0, 0), (-w, 1.0, 0, 0),
+                           (w + 1, SQRT2, 1, w), (w - 1, SQRT2, -1, w),
+                           (-w + 1, SQRT2, 1, -w), (-w - 1, SQRT2, -1, -w))
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build_passable(map):
+        # tile ids without a tile in the table are never passable
+        table = numpy.zeros(numpy.iinfo(map.data.dtype).max + 1, dtype=bool)
+        for i, tile in enumerate(map.tiles):
+            table[i] = BLOCKED not in tile.flags
+
+        return table[map.data]
+
+    def build_links(self):
+        """
+        Whether each chunk is linked to the chunk east of it and the one south
+        of it, padding the map out to whole chunks with blocked tiles.
+        """
+        size = self.chunk_size
+        tall, wide = self.chunks_tall, self.chunks_wide
+
+        padded = numpy.zeros((tall * size, wide * size), dtype=bool)
+        padded[:self.passable.shape[0], :self.passable.shape[1]] = \
+            self.passable
+
+        # pairs of passable tiles either side of each vertical and horizontal
+        # chunk border
+        across = padded[:, size - 1:-1:size] & padded[:, size::size]
+        down = padded[size - 1:-1:size, :] & padded[size::size, :]
+
+        east = numpy.zeros((tall, wide), dtype=bool)
+        south = numpy.zeros((tall, wide), dtype=bool)
+        east[:, :-1] = across.reshape(tall, size, wide - 1).any(axis=1)
+        south[:-1, :] = down.reshape(tall - 1, wide, size).any(axis=2)
+        return east, south
+
+    def passable_at(self, x, y):
+        height, width = self.passable.shape
+        return 0 <= x < width and 0 <= y < height and self.passable[y, x]
+
+    def clamp(self, x, y):
+        height, width = self.passable.shape
+        return min(max(x, 0), width - 1), min(max(y, 0), height - 1)
+
+    def node(self, x, y):
+        return (y + 1) * self.stride + x + 1
+
+    def tile(self, position):
+        return (int(position.x) // self.tile_size,
+                int(position.y) // self.tile_size)
+
+    def chunk_links(self, cid):
+        cy, cx = divmod(cid, self.chunks_wide)
+        wide = self.chunks_wide
+
+        if cx + 1 < wide and self.east[cy, cx]:
+            yield cid + 1
+        if cx > 0 and self.east[cy, cx - 1]:
+            yield cid - 1
+        if cy + 1 < self.chunks_tall and self.south[cy, cx]:
+            yield cid + wide
+        if cy > 0 and self.south[cy - 1, cx]:
+            yield cid - wide
+
+    def corridor(self, start, goal):
+        """
+        Chunk ids the tile search between `start` and `goal` may visit, None
+        for anywhere and an empty tuple when they can't be connected.
+        """
+        size = self.chunk_size
+        wide = self.chunks_wide
+
+        sx, sy = start[0] // size, start[1] // size
+        gx, gy = goal[0] // size, goal[1] // size
+
+        if max(abs(sx - gx), abs(sy - gy)) <= self.CORRIDOR_DISTANCE:
+            return None
+
+        source, target = sy * wide + sx, gy * wide + gx
+
+        open = [(0, source)]
+        parents = {source: None}
+        while open:
+            f, cid = heapq.heappop(open)
+            if cid == target:
+                break
+
+            g = f - abs(cid % wide - gx) - abs(cid // wide - gy) + 1
+            for link in self.chunk_links(cid):
+                if link not in parents:
+                    parents[link] = cid
+                    h = abs(link % wide - gx) + abs(link // wide - gy)
+                    heapq.heappush(open, (g + h, link))
+        else:
+            return ()
+
+        # the chunks on the route and the ones around them, paths hug
+        # borders more often than not
+        rv = set()
+        cid = target
+        while cid is not None:
+            cy, cx = divmod(cid, wide)
+            for y in xrange(max(cy - 1, 0), min(cy + 2, self.chunks_tall)):
+                for x in xrange(max(cx - 1, 0), min(cx + 2, wide)):
+                    rv.add(y * wide + x)
+            cid = parents[cid]
+
+        return rv
+
+    def cached(self, start, goal):
+        key = start, goal
+        path = self.cache.pop(key, None)
+
+        if path is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.cache[key] = path
+        return path
+
+    def remember(self, start, goal, path):
+        self.cache[start, goal] = path
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def search(self, start, goal):
+        return PathSearch(self, start, goal)
+
+    def waypoints(self, path, goal):
+        """
+        Pixel waypoints along a path of tiles, through the middle of each
+        turn and ending exactly on `goal`.
+        """
+        half = self.tile_size / 2.0
+        rv = [Vector(x * self.tile_size + half, y * self.tile_size + half)
+              for x, y in path[1:-1]]
+        rv.append(Vector(goal.x, goal.y))
+        return rv
+
+    def find(self, origin, goal):
+        """
+        Waypoints from pixel position `origin` to `goal`, None if there is no
+        way, searched right away.
+        """
+        start, end = self.tile(origin), self.tile(goal)
+
+        path = self.cached(start, end)
+        if path is None:
+            path = PathSearch(self, start, end).run()
+            if path is None:
+                return None
+
+            path = straighten(path)
+            self.remember(start, end, path)
+
+        return self.waypoints(path, goal)
+
+
+class PathService(object):
+    """
+    Path requests for avatars, searched a slice at a time over however many
+    ticks it takes.  A new request from an avatar replaces its pending one.
+    The map's pathfinder, and its region graph, is only built once the first
+    path is asked for.
+    """
+
+    # nodes expanded per tick over all searches, and per search per turn
+    BUDGET = 1000
+    SLICE = 250
+
+    def __init__(self, map, budget=BUDGET, slice=SLICE):
+        self.map = map
+        self.budget = budget
+        self.slice = slice
+
+        self.queue = deque()
+        self.pending = dict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def pathfinder(self):
+        return self.map.pathfinder
+
+    def request(self, avatar, goal):
+        pathfinder = self.pathfinder
+        start, end = pathfinder.tile(avatar.position), pathfinder.tile(goal)
+
+        path = pathfinder.cached(start, end)
+        if path is not None:
+            self.cancel(avatar)
+            avatar.follow(pathfinder.waypoints(path, goal))
+            return
+
+        if avatar.uid not in self.pending:
+            self.queue.append(avatar.uid)
+
+        self.pending[avatar.uid] = avatar, pathfinder.search(start, end), goal
+
+    def cancel(self, avatar):
+        self.pending.pop(avatar.uid, None)
+
+    def step(self):
+        if not self.queue:
+            return
+
+        pathfinder = self.pathfinder
+        budget = self.budget
+
+        # every pending search gets a slice in turn until the budget runs out
+        for i in xrange(len(self.queue)):
+            if budget <= 0:
+                break
+
+            uid = self.queue.popleft()
+            if uid not in self.pending:
+                continue
+
+            avatar, search, goal = self.pending[uid]
+            budget -= search.step(min(self.slice, budget))
+
+            if not search.done:
+                self.queue.append(uid)
+                continue
+
+            del self.pending[uid]
+
+            if search.path is not None:
+                path = straighten(search.path)
+                pathfinder.remember(search.start, search.goal, path)
+                avatar.follow(pathfinder.waypoints(path, goal))
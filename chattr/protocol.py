@@ -0,0 +1,205 @@
+# -----------------------------------------------------------------------------
+#
+# Wire protocols
+#
+# Every channel speaks one protocol, picked when the websocket connects.  JSON
+# is the default and the fallback, the binary protocol packs the high volume
+# messages (frames and map chunks) into binary websocket frames and falls back
+# to JSON text frames for everything else.
+#
+# Frames are stamped with the world tick, the world time in milliseconds since
+# the epoch, which advances a fixed step per tick and is what clients
+# interpolate by since tick numbers differ between region workers, and the
+# sequence number of the last input of the receiving client that was applied.
+#
+# Binary messages start with a type byte, all values are little endian:
+#
+#   frame  B type, I tick, d time, I ack, B flags, H count + avatars for spawn
+#          and update, H count + 16 byte uids for despawn
+#   chunk  B type, I id, H x, H y, H width, H height, width * height H tile
+#          ids
+#
+# Avatars are a 16 byte uid, a B field mask and then each present field:
+#
+#   size      B
+#   position  i i  fixed point, 1/16th of a pixel
+#   velocity  h h  fixed point, 1/256th of a pixel per tick
+#   rotation  h
+#   waypoint  i i  fixed point, 1/16th of a pixel
+#
+# A cleared waypoint sets its own mask bit and carries no value.
+# -----------------------------------------------------------------------------
+
+import binascii
+import json
+import math
+import numpy
+import struct
+
+from chattr.vector import Vector
+
+
+def json_encoder(obj):
+    if hasattr(obj, '__json__'):
+        return obj.__json__()
+
+    # numpy arrays and scalars
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+
+    raise TypeError('%s is not JSON serializable' % obj)
+
+def finite(value):
+    """
+    A number that is neither NaN nor infinite, nor too big to be a float.
+    Booleans are not numbers here.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return False
+
+    try:
+        value = float(value)
+    except OverflowError:
+        return False
+
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def parse_finite(text):
+    value = float(text)
+    if not finite(value):
+        raise ValueError('%s is out of range' % text)
+
+    return value
+
+
+def reject_constant(name):
+    raise ValueError('%s is not a number' % name)
+
+
+message = lambda type_, data=None: {'type': type_, 'data': data}
+flatten_message = lambda msg: json.dumps(msg, default=json_encoder)
+
+# NaN and Infinity are not JSON, python only accepts them by default
+parse_message = lambda data: json.loads(data, parse_float=parse_finite,
+                                        parse_constant=reject_constant)
+
+
+class JSONProtocol(object):
+    name = 'json'
+
+    def encode(self, msg):
+        return flatten_message(msg)
+
+    def encode_snapshot(self, avatar):
+        return flatten_message(avatar.stat())
+
+    def encode_delta(self, avatar):
+        return flatten_message(avatar.delta())
+
+    def encode_frame(self, tick, full, spawn, update, despawn, time=0, ack=0):
+        """
+        Assemble a `frame` message out of already encoded avatars, so each
+        avatar is serialized once per tick however many clients can see it.
+        """
+        return ('{"type": "frame", "data": {"tick": %d, "time": %.3f, '
+                '"ack": %d, "full": %s, "spawn": [%s], "update": [%s], '
+                '"despawn": %s}}' % (
+                    tick,
+                    time,
+                    ack,
+                    json.dumps(full),
+                    ', '.join(spawn),
+                    ', '.join(update),
+                    json.dumps(despawn)))
+
+
+class BinaryProtocol(JSONProtocol):
+    name = 'binary'
+
+    FRAME = 1
+    CHUNK = 2
+
+    FULL = 1
+    WAYPOINT_CLEARED = 32
+
+    POSITION_SCALE = 16.0
+    VELOCITY_SCALE = 256.0
+
+    # field mask bits, in packing order
+    FIELDS = (('size', 1, 'B'),
+              ('position', 2, 'ii'),
+              ('velocity', 4, 'hh'),
+              ('rotation', 8, 'h'),
+              ('waypoint', 16, 'ii'))
+
+    SCALES = {'position': POSITION_SCALE,
+              'velocity': VELOCITY_SCALE,
+              'waypoint': POSITION_SCALE}
+
+    def encode(self, msg):
+        packer = getattr(self, 'pack_' + msg['type'], None)
+
+        if packer is None:
+            return super(BinaryProtocol, self).encode(msg)
+
+        return bytearray(packer(msg['data']))
+
+    def pack_chunk(self, chunk):
+        tiles = numpy.asarray(chunk['data'], dtype='<u2')
+        height, width = tiles.shape
+
+        return (struct.pack('<BIHHHH', self.CHUNK, chunk['id'], chunk['x'],
+                            chunk['y'], width, height) +
+                tiles.tostring())
+
+    def pack_avatar(self, avatar, fields):
+        mask = 0
+        parts = [binascii.unhexlify(avatar.uid), None]
+
+        for name, bit, fmt in self.FIELDS:
+            if name not in fields:
+                continue
+
+            value = getattr(avatar, name)
+            if value is None:
+                mask |= self.WAYPOINT_CLEARED
+                continue
+
+            mask |= bit
+
+            if isinstance(value, Vector):
+                scale = self.SCALES[name]
+                parts.append(struct.pack('<' + fmt,
+                                         int(round(value.x * scale)),
+                                         int(round(value.y * scale))))
+            else:
+                parts.append(struct.pack('<' + fmt, value))
+
+        parts[1] = struct.pack('<B', mask)
+        return ''.join(parts)
+
+    def encode_snapshot(self, avatar):
+        return self.pack_avatar(avatar, avatar.FIELDS)
+
+    def encode_delta(self, avatar):
+        return self.pack_avatar(avatar, avatar.changed)
+
+    def encode_frame(self, tick, full, spawn, update, despawn, time=0, ack=0):
+        flags = self.FULL if full else 0
+
+        return bytearray(''.join([
+            struct.pack('<BIdIBH', self.FRAME, tick, time, ack, flags,
+                        len(spawn)),
+            ''.join(spawn),
+            struct.pack('<H', len(update)),
+            ''.join(update),
+            struct.pack('<H', len(despawn)),
+            ''.join(binascii.unhexlify(uid) for uid in despawn)]))
+
+
+PROTOCOLS = dict((p.name, p) for p in (JSONProtocol(), BinaryProtocol()))
+
+
+def negotiate(name):
+    return PROTOCOLS.get(name, PROTOCOLS[JSONProtocol.name])
@@ -0,0 +1,363 @@
+# -----------------------------------------------------------------------------
+#
+# Replay logs
+#
+# A world can record what goes into it to an append-only log: its seed and
+# the avatars and players it starts with, then every avatar spawned and
+# killed, every client attached and detached, every message enqueued and
+# every change of degradation level, each tagged with the tick that
+# dispatches it.  Everything random in the world follows from
+# its seed, so replaying a log runs the same session again, headless and as
+# fast as the ticks go, which turns real traffic into a benchmark and lets a
+# hot tick be profiled after the fact:
+#
+#   python -m chattr.replay session.log --profile session.prof --ticks 900:950
+#
+# The log is a header followed by one pickled tuple per entry:
+#
+#   ('spawn', tick, exported)   ('message', tick, uid, msg)
+#   ('kill', tick, uid)         ('level', tick, level)
+#   ('attach', tick, uid)       ('detach', tick, uid)
+#   ('clock', tick, clock)      ('end', tick)
+#
+# A replay has no clients, but once the world degrades, NPCs away from
+# players tick less often, so which avatars are players is replayed too.
+#
+# Avatars are kept in sets, which iterate in the order of their hashes, by
+# memory address by default.  Who gets its path searched first or who is
+# pushed out of whom depends on that order, so worlds that are recorded or
+# replayed are built replayable, their avatars are hashed by uid instead, see
+# chattr.uid_hashed().
+#
+# Only single worlds are recorded, the regions of a sharded world also trade
+# avatars between each other.
+# -----------------------------------------------------------------------------
+
+import argparse
+import cPickle as pickle
+import cProfile
+import json
+import logging
+import pstats
+import time
+
+from chattr import Map, WorldThread
+from chattr.loadtest import percentile
+from chattr.protocol import message
+from chattr.scheduler import Scheduler
+from chattr.shard import export_avatar, restore_avatar
+
+log = logging.getLogger(__name__)
+
+
+class ReplayLog(object):
+    """
+    Records the inputs of a world to `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.world = None
+        self.last_level = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('chattr.replay_log')
+        if not path:
+            return None
+
+        return cls(path)
+
+    def start(self, world):
+        """
+        Start recording `world`, with the avatars it already has.  The world
+        has to be built replayable.
+        """
+        if not world.replayable:
+            raise ValueError('the world hashes avatars by address, its '
+                             'sessions can not be replayed')
+
+        scheduler = world.scheduler
+
+        # simulated avatars are restored into the slots they had
+        avatars = sorted(world.avatars.all(),
+                         key=lambda avatar: getattr(avatar, 'slot', -1))
+
+        header = {'seed': world.seed,
+                  'ticks': world.ticks,
+                  'clock': world.clock,
+                  'tps': scheduler.tps,
+                  'send_every': scheduler.send_every,
+                  'far_stride': scheduler.far_stride,
+                  'level': scheduler.level,
+                  'avatars': [export_avatar(avatar) for avatar in avatars],
+                  'players': sorted(world.players())}
+
+        self.file = open(self.path, 'wb')
+        self.write(header)
+
+        self.world = world
+        self.last_level = scheduler.level
+        world.recorder = self
+
+        log.info('recording world inputs to %s', self.path)
+
+    def stop(self):
+        if self.world is None:
+            return
+
+        self.world.recorder = None
+        self.write(('end', self.world.ticks))
+        self.file.close()
+        self.world = None
+
+    def write(self, entry):
+        pickle.dump(entry, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def flush(self):
+        self.file.flush()
+
+    def spawn(self, tick, avatar):
+        self.write(('spawn', tick, export_avatar(avatar)))
+
+    def message(self, tick, avatar, msg):
+        self.write(('message', tick, avatar.uid, msg))
+
+    def kill(self, tick, avatar):
+        self.write(('kill', tick, avatar.uid))
+
+    def attach(self, tick, avatar):
+        self.write(('attach', tick, avatar.uid))
+
+    def detach(self, tick, avatar):
+        self.write(('detach', tick, avatar.uid))
+
+    def level(self, tick, level):
+        if level != self.last_level:
+            self.last_level = level
+            self.write(('level', tick, level))
+
+    def clock(self, tick, clock):
+        self.write(('clock', tick, clock))
+
+
+def read_log(path):
+    """
+    The header of a replay log, and an iterator over its entries.
+    """
+    f = open(path, 'rb')
+    header = pickle.load(f)
+
+    def entries():
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    # the end, or an entry cut short by a world that died
+                    return
+                except pickle.UnpicklingError:
+                    log.warning('%s ends with a partial entry', path)
+                    return
+
+    return header, entries()
+
+
+class ReplayWorld(WorldThread):
+    """
+    A world whose players are the ones recorded, not its channels.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayWorld, self).__init__(*args, **kwargs)
+        self.attached = set()
+
+    def players(self):
+        return self.attached
+
+
+class Replay(object):
+    """
+    Runs the session recorded in a replay log in a world of its own, without
+    a scheduler's clock or any clients.
+    """
+
+    def __init__(self, map, path):
+        self.header, self.entries = read_log(path)
+        header = self.header
+
+        scheduler = Scheduler(tps=header['tps'],
+                              send_rate=header['tps'] / header['send_every'],
+                              degrade=False, far_stride=header['far_stride'])
+        scheduler.level = header['level']
+
+        self.world = world = ReplayWorld(map, scheduler, seed=header['seed'],
+                                          replayable=True)
+        world.ticks = header['ticks']
+        world.clock = header['clock']
+        world.attached.update(header.get('players', ()))
+
+        for exported in header['avatars']:
+            restore_avatar(world, exported)
+
+        self.end = None
+        self.next = None
+
+        # milliseconds each replayed tick took
+        self.times = []
+
+    def apply(self, entry):
+        world = self.world
+        kind, tick = entry[:2]
+
+        if kind == 'spawn':
+            avatar = restore_avatar(world, entry[2])
+            world.input.put(avatar, message('spawn'), required=True)
+
+        elif kind == 'message':
+            avatar = world.avatars.get(entry[2])
+            if avatar:
+                world.enqueue(avatar, entry[3])
+
+        elif kind == 'kill':
+            avatar = world.avatars.get(entry[2])
+            if avatar:
+                world.kill(avatar)
+
+            world.attached.discard(entry[2])
+
+        elif kind == 'attach':
+            world.attached.add(entry[2])
+
+        elif kind == 'detach':
+            world.attached.discard(entry[2])
+
+        elif kind == 'level':
+            world.scheduler.level = entry[2]
+
+        elif kind == 'clock':
+            world.clock = entry[2]
+
+        elif kind == 'end':
+            self.end = tick
+
+    def feed(self):
+        """
+        Apply the entries for the next tick, False once the log is done.
+        """
+        ticks = self.world.ticks
+
+        while self.end is None:
+            if self.next is None:
+                self.next = next(self.entries, None)
+
+                # a log cut short ends with the tick of its last entries
+                if self.next is None:
+                    self.end = ticks + 1
+                    break
+
+            if self.next[1] > ticks:
+                break
+
+            self.apply(self.next)
+            self.next = None
+
+        return self.end is None or ticks < self.end
+
+    def run(self, limit=None, profiler=None, ticks=(None, None)):
+        """
+        Replay the log, or `limit` ticks of it.  Ticks in the range `ticks`
+        run under `profiler` when given.
+        """
+        world = self.world
+        step = world.scheduler.step
+        first = world.ticks
+        start, stop = ticks
+
+        while self.feed():
+            if limit is not None and world.ticks - first >= limit:
+                break
+
+            profiling = (profiler is not None and
+                         (start is None or start <= world.ticks) and
+                         (stop is None or world.ticks < stop))
+
+            if profiling:
+                profiler.enable()
+
+            began = time.time()
+            world.tick(step)
+            self.times.append((time.time() - began) * 1000.0)
+
+            if profiling:
+                profiler.disable()
+
+            world.ticks += 1
+
+    def report(self, hot=10):
+        world = self.world
+        times = self.times
+        first = self.header['ticks']
+        ms = lambda value: round(value, 3)
+
+        hottest = sorted(xrange(len(times)), key=times.__getitem__,
+                         reverse=True)[:hot]
+
+        return {
+            'ticks': len(times),
+            'avatars': len(world.avatars.avatars),
+            'replay_seconds': ms(sum(times) / 1000.0),
+            'tick_mean_ms': ms(sum(times) / len(times) if times else 0),
+            'tick_p50_ms': ms(percentile(times, 50)),
+            'tick_p99_ms': ms(percentile(times, 99)),
+            'tick_max_ms': ms(max(times or [0])),
+            'phase_ms': dict((phase, ms(histogram.sum * 1000.0))
+                             for phase, histogram
+                             in world.phase_times.items()),
+            'hottest_ticks': [(first + i, ms(times[i])) for i in hottest],
+        }
+
+
+def parse_range(value):
+    start, _, stop = value.partition(':')
+    return int(start) if start else None, int(stop) if stop else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a recorded chattr session headless')
+    parser.add_argument('log')
+    parser.add_argument('--map', default='map.json')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='stop after this many ticks')
+    parser.add_argument('--profile', default=None,
+                        help='write cProfile stats to this file')
+    parser.add_argument('--ticks', type=parse_range, default=(None, None),
+                        help='only profile ticks FIRST:LAST')
+    parser.add_argument('--hot', type=int, default=10,
+                        help='slowest ticks to report')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+
+    replay = Replay(Map.load(args.map), args.log)
+
+    profiler = cProfile.Profile() if args.profile else None
+    replay.run(args.limit, profiler, args.ticks)
+
+    report = replay.report(args.hot)
+
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        for key in sorted(report):
+            print '%-32s %s' % (key, report[key])
+
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+if __name__ == '__main__':
+    main()
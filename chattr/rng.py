@@ -0,0 +1,42 @@
+# -----------------------------------------------------------------------------
+#
+# Per avatar random numbers
+#
+# Every avatar draws from a generator of its own, seeded from its uid, so what
+# it does only depends on the seed and on what happened to it, not on who else
+# drew numbers before it.  random.Random carries 2.5KB of state, too much for
+# 100k avatars, this is splitmix64 in a single integer.
+# -----------------------------------------------------------------------------
+
+MASK = (1 << 64) - 1
+
+
+class Rng(object):
+    __slots__ = 'state',
+
+    def __init__(self, seed=0):
+        self.state = seed & MASK
+
+    def __reduce__(self):
+        return Rng, (self.state,)
+
+    def __repr__(self):
+        return 'Rng(%d)' % self.state
+
+    def next(self):
+        self.state = z = (self.state + 0x9e3779b97f4a7c15) & MASK
+        z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+        z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & MASK
+        return z ^ (z >> 31)
+
+    def random(self):
+        """
+        A float in [0, 1).
+        """
+        return (self.next() >> 11) * (1.0 / (1 << 53))
+
+    def randint(self, a, b):
+        """
+        An integer in [a, b], like random.randint.
+        """
+        return a + self.next() % (b - a + 1)
@@ -0,0 +1,89 @@
+# -----------------------------------------------------------------------------
+#
+# Tick scheduling
+#
+# The world advances in fixed steps of 1 / tps seconds.  Real time elapsed is
+# measured and accumulated, and the world runs as many steps as fit, up to
+# `max_catch_up` at once, past that the backlog is dropped rather than letting
+# an overloaded world fall further and further behind.
+#
+# Each tick has a budget, a fraction of the step.  When ticks run over budget
+# for a while the world degrades a level at a time, and recovers the same way
+# once ticks are comfortably under budget again:
+#
+#   1  NPCs away from every player tick every `far_stride` ticks
+#   2  frames and terrain are sent half as often
+#   3  a quarter as often, and notices are no longer broadcast
+# -----------------------------------------------------------------------------
+
+
+class Scheduler(object):
+    MAX_LEVEL = 3
+
+    # smoothing of the tick load, and ticks between degradation changes
+    ALPHA = 0.1
+    COOLDOWN = 20
+
+    def __init__(self, tps=10.0, send_rate=None, max_catch_up=5, budget=0.8,
+                 degrade=True, far_stride=4):
+        self.tps = float(tps)
+        self.step = 1000.0 / self.tps
+
+        # frames go out every `send_every` ticks when not degraded
+        send_rate = float(send_rate or tps)
+        self.send_every = max(int(round(self.tps / send_rate)), 1)
+
+        self.max_catch_up = max_catch_up
+        self.budget = budget
+        self.degrade = degrade
+        self.far_stride = far_stride
+
+        # tick time as a fraction of the step, smoothed
+        self.load = 0.0
+        self.level = 0
+        self.cooldown = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        from pyramid.settings import asbool
+
+        get = lambda key, default: settings.get('chattr.' + key, default)
+
+        return cls(tps=float(get('tps', 10.0)),
+                   send_rate=float(get('send_rate', 0)) or None,
+                   max_catch_up=int(get('max_catch_up', 5)),
+                   budget=float(get('tick_budget', 0.8)),
+                   degrade=asbool(get('degrade', True)),
+                   far_stride=int(get('far_stride', 4)))
+
+    def observe(self, elapsed):
+        """
+        Record how long a tick took, in milliseconds, and adjust the level.
+        """
+        self.load += self.ALPHA * (elapsed / self.step - self.load)
+
+        if self.cooldown:
+            self.cooldown -= 1
+            return
+
+        if not self.degrade:
+            return
+
+        if self.load > self.budget and self.level < self.MAX_LEVEL:
+            self.level += 1
+            self.cooldown = self.COOLDOWN
+        elif self.load < self.budget / 2 and self.level > 0:
+            self.level -= 1
+            self.cooldown = self.COOLDOWN
+
+    def send_interval(self):
+        return self.send_every << max(self.level - 1, 0)
+
+    def sending(self, tick):
+        return tick % self.send_interval() == 0
+
+    def npc_stride(self):
+        return self.far_stride if self.level >= 1 else 1
+
+    def essential_only(self):
+        return self.level >= self.MAX_LEVEL
@@ -0,0 +1,565 @@
+# -----------------------------------------------------------------------------
+#
+# Sharded world
+#
+# The map is cut into a grid of regions and every region is simulated by a
+# WorldThread in its own forked worker process, so the world can use more
+# than one core.  The front process keeps the websocket Channels, routes each
+# client's messages to the worker owning its avatar and writes the frames the
+# worker sends back.  Workers talk to the front over a unix socketpair, each
+# message a length prefixed pickle of (kind, connection id, arguments...).
+#
+# Inside a worker every client is a ProxyChannel, which forwards its frames to
+# the front instead of writing them to a socket.  The front keeps the real
+# queues, it tells the workers which of their clients are congested or lost
+# state frames, so they back off and resync them as a single world would.
+# When an avatar walks out of its worker's region the worker exports it and
+# hands it off through the front, which passes it on to the region it walked
+# into and reroutes the client, whose new worker sends it a full frame.
+#
+# Workers push their metrics to the front every second, /metrics serves them
+# along with the front's own, labelled with their region.
+#
+# Workers do not share avatars near their borders, clients only see the
+# avatars in their own region.
+# -----------------------------------------------------------------------------
+
+from gevent.queue import Queue
+import gevent
+
+import cPickle as pickle
+import itertools
+import logging
+import os
+import socket
+import struct
+
+from chattr import (Avatar, Channel, ChannelMetrics, OutgoingQueue,
+                    SimulatedWanderer, Wanderer, WorldThread, negotiate)
+from chattr.metrics import Counter, Gauge, Registry
+from chattr.vector import Vector
+
+log = logging.getLogger(__name__)
+
+# state carried over when an avatar changes region
+EXPORTED = ('uid', 'size', 'position', 'velocity', 'rotation', 'waypoint',
+            'path', 'ticks', 'input_seq', 'rng')
+
+AVATAR_TYPES = dict((cls.__name__, cls)
+                    for cls in (Avatar, Wanderer, SimulatedWanderer))
+
+
+def export_avatar(avatar):
+    state = dict((name, getattr(avatar, name)) for name in EXPORTED)
+
+    if isinstance(avatar, Wanderer):
+        state['range'] = avatar.range
+        state['rest'] = avatar.rest
+
+    return type(avatar).__name__, state
+
+
+def restore_avatar(world, exported):
+    """
+    Recreate an exported avatar in `world`, under the same uid.
+    """
+    name, state = exported
+    cls = world.avatar_class(AVATAR_TYPES[name])
+
+    avatar = cls.__new__(cls)
+    if cls.simulated:
+        avatar.simulation = world.avatars.simulation
+        avatar.slot = avatar.simulation.add(avatar)
+
+    for key, value in state.items():
+        setattr(avatar, key, value)
+
+    avatar.changed = set(avatar.FIELDS)
+    avatar.paths = world.paths
+
+    world.avatars.add(avatar)
+    world.objects.add(avatar)
+    return avatar
+
+
+class Link(object):
+    """
+    One end of a socketpair between the front and a worker.  Sends are queued
+    and written by a greenlet, batching whatever piled up since its last write.
+    """
+
+    HEADER = struct.Struct('<I')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        self.outgoing = Queue(None)
+        self.writer = gevent.spawn(self.do_write)
+
+    def send(self, *msg):
+        self.outgoing.put(msg)
+
+    def do_write(self):
+        running = True
+
+        while running:
+            msgs = [self.outgoing.get()]
+            while not self.outgoing.empty():
+                msgs.append(self.outgoing.get())
+
+            parts = []
+            for msg in msgs:
+                if msg == (None,):
+                    running = False
+                    break
+
+                data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+                parts.append(self.HEADER.pack(len(data)))
+                parts.append(data)
+
+            try:
+                self.sock.sendall(''.join(parts))
+            except socket.error, e:
+                log.error('Error writing to link: %s', e)
+                break
+
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def receive(self):
+        header = self.file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return None
+
+        size, = self.HEADER.unpack(header)
+        return pickle.loads(self.file.read(size))
+
+    def close(self):
+        self.send(None)
+        self.writer.join()
+
+
+class Regions(object):
+    """
+    A grid of `columns` x `rows` regions over a map, in pixels.
+    """
+
+    def __init__(self, map, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.width = float(map.width * map.tile_size)
+        self.height = float(map.height * map.tile_size)
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def locate(self, position):
+        column = int(position.x * self.columns // self.width)
+        row = int(position.y * self.rows // self.height)
+
+        column = min(max(column, 0), self.columns - 1)
+        row = min(max(row, 0), self.rows - 1)
+        return row * self.columns + column
+
+    def bounds(self, region):
+        row, column = divmod(region, self.columns)
+        w = self.width / self.columns
+        h = self.height / self.rows
+        return column * w, row * h, (column + 1) * w, (row + 1) * h
+
+
+class ProxyChannel(Channel):
+    """
+    A client as seen from a worker, frames are forwarded to the front which
+    owns the real Channel, its queue and the socket.
+    """
+
+    def __init__(self, link, cid, protocol):
+        super(ProxyChannel, self).__init__(None, protocol)
+        self.link = link
+        self.cid = cid
+
+        # as last reported by the front
+        self.backlogged = False
+
+    def congested(self):
+        return self.backlogged
+
+    def send_frame(self, frame, kind=OutgoingQueue.CRITICAL):
+        if self.closed:
+            return False
+
+        self.link.send('frame', self.cid, frame, kind)
+        return True
+
+    def close(self, reason):
+        self.closed = reason
+        self.link.send('close', self.cid, reason)
+
+
+class RegionWorld(WorldThread):
+    """
+    The world of one region, run by a worker process.
+    """
+
+    # random spots tried for a new avatar before settling for blocked terrain
+    PLACE_ATTEMPTS = 20
+
+    # seconds between metrics pushed to the front
+    METRICS_INTERVAL = 1.0
+
+    def __init__(self, map, regions, region, link, scheduler=None):
+        super(RegionWorld, self).__init__(map, scheduler)
+        self.regions = regions
+        self.region = region
+        self.link = link
+
+        # connection ids of the clients in this region, and their avatars
+        self.clients = dict()
+
+        # NPCs restored from a snapshot
+        self.restored = 0
+
+    def place(self, avatar):
+        x0, y0, x1, y1 = self.regions.bounds(self.region)
+
+        for i in range(self.PLACE_ATTEMPTS):
+            position = Vector(self.random.uniform(x0, x1),
+                              self.random.uniform(y0, y1))
+            if self.map.passable(position):
+                break
+
+        self.avatars.teleport(avatar, position)
+
+    def tick(self, delta):
+        super(RegionWorld, self).tick(delta)
+        self.hand_off()
+
+    def hand_off(self):
+        cids = dict((avatar.uid, cid) for cid, avatar in self.clients.items())
+
+        # only an avatar that moved can have left
+        for avatar in self.moved:
+            region = self.regions.locate(avatar.position)
+            if region == self.region:
+                continue
+
+            # the terrain the client has goes along, it is not sent again
+            client = None
+
+            cid = cids.get(avatar.uid)
+            if cid is not None:
+                channel = self.channels.get(avatar)
+                client = channel.chunks, channel.chunk
+
+                del self.clients[cid]
+                self.detach(avatar)
+
+            # everybody else here sees it despawn with the next frame
+            self.paths.cancel(avatar)
+            self.avatars.remove(avatar)
+            self.objects.discard(avatar)
+
+            self.link.send('handoff', cid, region, export_avatar(avatar),
+                           client)
+
+    def on_connect(self, cid, protocol):
+        avatar = self.spawn()
+        self.place(avatar)
+
+        self.clients[cid] = avatar
+        self.attach(avatar, ProxyChannel(self.link, cid, negotiate(protocol)))
+
+    def on_message(self, cid, msg):
+        # messages can still arrive for a client that was just handed off
+        avatar = self.clients.get(cid)
+        if avatar:
+            self.enqueue(avatar, msg)
+
+    def on_disconnect(self, cid):
+        avatar = self.clients.pop(cid, None)
+        if avatar:
+            self.detach(avatar)
+            self.kill(avatar)
+
+    def on_adopt(self, cid, protocol, exported, client=None):
+        avatar = restore_avatar(self, exported)
+
+        if cid is not None:
+            channel = ProxyChannel(self.link, cid, negotiate(protocol))
+            if client:
+                channel.chunks, channel.chunk = client
+
+            self.clients[cid] = avatar
+            self.attach(avatar, channel)
+
+    def on_channel_state(self, cid, congested, resync):
+        avatar = self.clients.get(cid)
+        channel = avatar and self.channels.get(avatar)
+
+        if channel:
+            channel.backlogged = congested
+            channel.resync = channel.resync or resync
+
+    def push_metrics(self):
+        while True:
+            gevent.sleep(self.METRICS_INTERVAL)
+            self.link.send('metrics', None, self.metrics.collect())
+
+    def on_spawn_npcs(self, count, simulation):
+        if self.restored:
+            return
+
+        for i in range(count):
+            if simulation == 'array':
+                avatar = self.spawn(SimulatedWanderer,
+                                    args=(self.avatars.simulation, 100))
+            else:
+                avatar = self.spawn(Wanderer, args=(100,))
+
+            self.place(avatar)
+
+    def serve_link(self):
+        while True:
+            msg = self.link.receive()
+            if msg is None:
+                break
+
+            getattr(self, 'on_' + msg[0])(*msg[1:])
+
+
+def run_worker(map, regions, region, sock, scheduler=None, snapshots=None):
+    link = Link(sock)
+    world = RegionWorld(map, regions, region, link, scheduler)
+
+    if snapshots:
+        snapshots = snapshots.region(region)
+        world.restored = snapshots.restore(world)
+
+    world.start()
+    pusher = gevent.spawn(world.push_metrics)
+
+    if snapshots:
+        snapshots.start(world)
+
+    world.serve_link()
+
+    if snapshots:
+        snapshots.stop()
+
+    pusher.kill()
+
+    world.running = False
+    world.join()
+    link.close()
+
+
+class ShardedWorld(object):
+    """
+    The front process, serves Channels like a WorldThread would but leaves
+    the simulation to one worker per region.
+    """
+
+    def __init__(self, map, columns, rows, scheduler=None, snapshots=None):
+        self.map = map
+        self.regions = Regions(map, columns, rows)
+        self.scheduler = scheduler
+        self.snapshots = snapshots
+
+        self.links = []
+        self.pids = []
+        self.readers = []
+
+        self.cids = itertools.count()
+        self.channels = dict()
+        self.routes = dict()
+
+        # congestion of each client as last told to its worker
+        self.reported = dict()
+        self.monitor = None
+
+        # the latest metrics pushed by each region's worker
+        self.region_metrics = dict()
+
+        # the real sockets are written here, not by the workers
+        self.channel_metrics = ChannelMetrics()
+
+        self.metrics = Registry()
+        self.handoffs = self.metrics.counter(
+            'chattr_handoffs_total', 'Avatars handed off between regions')
+        self.metrics.collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """
+        The workers' metrics labelled by region, except for the channel
+        traffic, which is counted here where the sockets are.  Workers only
+        add the messages their handlers reject.
+        """
+        rv = self.channel_metrics.collect(self.channels.values())
+        totals = dict((metric.name, metric) for metric in rv)
+
+        for region, metrics in self.region_metrics.items():
+            for metric in metrics:
+                if metric.name in ChannelMetrics.NAMES:
+                    if isinstance(metric, Counter):
+                        totals[metric.name].inc(metric.value)
+                    continue
+
+                metric.labels = dict(metric.labels, region=region)
+                rv.append(metric)
+
+        for region in range(len(self.regions)):
+            gauge = Gauge('chattr_region_channels',
+                          'Clients connected to a region',
+                          {'region': region})
+            gauge.set(sum(1 for r in self.routes.values() if r == region))
+            rv.append(gauge)
+
+        return rv
+
+    def start(self):
+        # fork every worker before the front has greenlets of its own
+        pairs = [socket.socketpair() for region in range(len(self.regions))]
+
+        for region, (front, worker) in enumerate(pairs):
+            pid = os.fork()
+            if pid == 0:
+                for f, w in pairs:
+                    f.close()
+                    if w is not worker:
+                        w.close()
+
+                try:
+                    run_worker(self.map, self.regions, region, worker,
+                               self.scheduler, self.snapshots)
+                finally:
+                    os._exit(0)
+
+            self.pids.append(pid)
+
+        for region, (front, worker) in enumerate(pairs):
+            worker.close()
+
+            link = Link(front)
+            self.links.append(link)
+            self.readers.append(gevent.spawn(self.read_link, region, link))
+
+        self.monitor = gevent.spawn(self.monitor_channels)
+
+    def stop(self):
+        self.monitor.kill()
+
+        for link in self.links:
+            link.close()
+
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+
+        gevent.killall(self.readers)
+
+    def spawn_npcs(self, count, simulation='object'):
+        n = len(self.regions)
+        for region, link in enumerate(self.links):
+            link.send('spawn_npcs', count // n + (region < count % n),
+                      simulation)
+
+    def monitor_channels(self):
+        """
+        Tell the workers which of their clients are congested, or lost state
+        frames and need a full one.  Congested clients have their queued state
+        dropped, a full frame replaces it once they catch up.
+        """
+        step = (self.scheduler.step if self.scheduler else 100.0) / 1000.0
+
+        while True:
+            gevent.sleep(step)
+
+            for cid, channel in self.channels.items():
+                congested = channel.congested()
+
+                if congested:
+                    dropped = channel.outgoing.discard(OutgoingQueue.STATE)
+                    if dropped:
+                        channel.dropped_frames += dropped
+                        channel.resync = True
+
+                resync, channel.resync = channel.resync, False
+
+                if resync or congested != self.reported.get(cid, False):
+                    self.reported[cid] = congested
+                    self.links[self.routes[cid]].send(
+                        'channel_state', cid, congested, resync)
+
+    def read_link(self, region, link):
+        while True:
+            msg = link.receive()
+            if msg is None:
+                break
+
+            kind, cid = msg[0], msg[1]
+
+            if kind == 'frame':
+                channel = self.channels.get(cid)
+                if channel:
+                    channel.send_frame(*msg[2:])
+
+            elif kind == 'close':
+                channel = self.channels.get(cid)
+                if channel:
+                    channel.close(msg[2])
+
+            elif kind == 'handoff':
+                self.hand_off(cid, *msg[2:])
+
+            elif kind == 'metrics':
+                self.region_metrics[region] = msg[2]
+
+    def hand_off(self, cid, region, exported, client=None):
+        protocol = None
+
+        if cid is not None:
+            channel = self.channels.get(cid)
+
+            # the client left while its avatar was on the way
+            if channel is None:
+                return
+
+            protocol = channel.protocol.name
+            self.routes[cid] = region
+
+            # the new worker starts out thinking the client is keeping up
+            self.reported.pop(cid, None)
+
+        self.handoffs.inc()
+        self.links[region].send('adopt', cid, protocol, exported, client)
+
+    def least_loaded(self):
+        load = [0] * len(self.regions)
+        for region in self.routes.values():
+            load[region] += 1
+
+        return load.index(min(load))
+
+    def serve(self, channel):
+        cid = next(self.cids)
+        region = self.least_loaded()
+
+        self.channels[cid] = channel
+        self.routes[cid] = region
+        self.links[region].send('connect', cid, channel.protocol.name)
+
+        channel.run()
+
+        try:
+            while channel.is_running():
+                msg = channel.receive()
+                if not msg:
+                    break
+
+                self.links[self.routes[cid]].send('message', cid, msg)
+        finally:
+            channel.wait()
+
+            self.links[self.routes.pop(cid)].send('disconnect', cid)
+            self.reported.pop(cid, None)
+            del self.channels[cid]
+            self.channel_metrics.retire(channel)
@@ -0,0 +1,123 @@
+import numpy
+
+
+class Simulation(object):
+    """
+    Structure of arrays NPC simulation.  Positions, velocities, waypoints and
+    rest timers for every simulated wanderer live in NumPy arrays and the
+    waypoint steering from Avatar.tick and Wanderer.tick runs as batched
+    array operations, the avatars themselves only hold their slot.
+    """
+
+    def __init__(self, capacity=1024, seed=None):
+        self.size = 0
+        self.avatars = []
+        self.random = numpy.random.RandomState(seed)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        def grow(old, shape, dtype):
+            new = numpy.zeros(shape, dtype=dtype)
+            if old is not None:
+                new[:self.size] = old[:self.size]
+            return new
+
+        get = lambda name: getattr(self, name, None)
+
+        self.position = grow(get('position'), (capacity, 2), float)
+        self.velocity = grow(get('velocity'), (capacity, 2), float)
+        self.waypoint = grow(get('waypoint'), (capacity, 2), float)
+        self.has_waypoint = grow(get('has_waypoint'), capacity, bool)
+        self.rest = grow(get('rest'), capacity, float)
+        self.range = grow(get('range'), capacity, float)
+        self.capacity = capacity
+
+    def add(self, avatar):
+        if self.size == self.capacity:
+            self.allocate(self.capacity * 2)
+
+        slot = self.size
+        self.size += 1
+        self.avatars.append(avatar)
+
+        for array in (self.position, self.velocity, self.waypoint,
+                      self.has_waypoint, self.rest, self.range):
+            array[slot] = 0
+
+        return slot
+
+    def remove(self, avatar):
+        """
+        Swap the last avatar into the removed avatar's slot to keep the
+        arrays dense.
+        """
+        slot = avatar.slot
+        last = self.size - 1
+
+        if slot != last:
+            for array in (self.position, self.velocity, self.waypoint,
+                          self.has_waypoint, self.rest, self.range):
+                array[slot] = array[last]
+
+            moved = self.avatars[last]
+            moved.slot = slot
+            self.avatars[slot] = moved
+
+        self.avatars.pop()
+        self.size -= 1
+
+    def tick(self, delta, speed):
+        """
+        Advance every simulated avatar by `delta` milliseconds, heading for
+        waypoints at `speed` pixels per millisecond.  Returns the slots that
+        moved, changed velocity and changed waypoint, for dirty tracking.
+        """
+        n = self.size
+        position = self.position[:n]
+        velocity = self.velocity[:n]
+        waypoint = self.waypoint[:n]
+        has_waypoint = self.has_waypoint[:n]
+        rest = self.rest[:n]
+
+        # Wanderer.tick: pick a new waypoint once rested, otherwise rest
+        idle = ~has_waypoint
+        pick = idle & (rest <= 0)
+        rest[idle & ~pick] -= delta
+
+        picked = numpy.flatnonzero(pick)
+        if len(picked):
+            span = self.range[picked, numpy.newaxis]
+            offset = numpy.floor(self.random.random_sample((len(picked), 2)) *
+                                 (2 * span + 1)) - span
+            waypoint[picked] = position[picked] + offset
+            has_waypoint[picked] = True
+            rest[picked] = self.random.randint(1500, 3001, len(picked))
+
+        # Avatar.tick: steer towards the waypoint, snap to it once close
+        moving = numpy.flatnonzero(has_waypoint)
+        to_waypoint = waypoint[moving] - position[moving]
+        distance = numpy.hypot(to_waypoint[:, 0], to_waypoint[:, 1])
+
+        step = speed * delta
+        arrived = distance <= step
+        steering = ~arrived
+
+        old_velocity = numpy.round(velocity[moving], 2)
+
+        new_velocity = numpy.zeros_like(to_waypoint)
+        new_velocity[steering] = (to_waypoint[steering] /
+                                  distance[steering, numpy.newaxis])
+
+        new_position = position[moving]
+        new_position[arrived] = waypoint[moving][arrived]
+        new_position += new_velocity * step
+
+        position[moving] = new_position
+        velocity[moving] = new_velocity
+        has_waypoint[moving[arrived]] = False
+
+        turned = (numpy.round(new_velocity, 2) != old_velocity).any(axis=1)
+
+        return (moving,
+                moving[turned | arrived],
+                numpy.union1d(picked, moving[arrived]))
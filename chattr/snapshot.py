@@ -0,0 +1,242 @@
+# -----------------------------------------------------------------------------
+#
+# World snapshots
+#
+# NPCs are saved to disk every `interval` seconds so a restart picks up where
+# the world left off.  Every `full_every`th snapshot is full, the ones in
+# between only carry the NPCs that changed and the uids of the ones removed
+# since the snapshot before.  Players are not saved, their avatars go away
+# with their connections anyway.
+#
+# The world is never serialized on the tick path.  A snapshot is written by
+# its own greenlet a slice of NPCs at a time, yielding to the world between
+# slices, so the world only ever stops for one slice however many NPCs
+# there are.  NPCs changing while a snapshot is written are saved by the
+# next one.  Files are written under a temporary name and renamed once
+# complete, a snapshot that fails leaves nothing behind and the next one is
+# a full one.
+#
+#   <seq>.full  <seq>.incr  pickles of a header, lists of exported NPCs up to
+#                           a None, the list of removed uids
+#
+# Restoring loads the latest full snapshot and replays the incremental ones
+# taken after it.
+# -----------------------------------------------------------------------------
+
+import gevent
+
+import cPickle as pickle
+import itertools
+import logging
+import os
+import time
+
+from chattr import NPC
+from chattr.shard import export_avatar, restore_avatar
+
+log = logging.getLogger(__name__)
+
+FULL = 'full'
+INCREMENTAL = 'incr'
+
+
+def snapshot_files(directory):
+    """
+    (seq, kind, path) of the complete snapshots in `directory`, oldest first.
+    """
+    rv = []
+
+    for name in os.listdir(directory):
+        seq, _, kind = name.partition('.')
+        if kind in (FULL, INCREMENTAL) and seq.isdigit():
+            rv.append((int(seq), kind, os.path.join(directory, name)))
+
+    return sorted(rv)
+
+
+def read_snapshot(path):
+    exported = []
+
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+
+        for part in iter(lambda: pickle.load(f), None):
+            exported.extend(part)
+
+        removed = pickle.load(f)
+
+    return header, exported, removed
+
+
+class Snapshots(object):
+    # NPCs serialized before yielding to the world
+    SLICE = 100
+
+    # pause, in seconds, of the world to write a slice
+    PAUSE_BUCKETS = (.0005, .001, .002, .003, .005, .01, .025, .05, .1)
+
+    def __init__(self, directory, interval=30, full_every=10):
+        self.directory = directory
+        self.interval = interval
+        self.full_every = full_every
+
+        self.seq = 0
+        self.since_full = None
+        self.greenlet = None
+        self.world = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        directory = settings.get('chattr.snapshots')
+        if not directory:
+            return None
+
+        return cls(directory,
+                   interval=float(settings.get('chattr.snapshot_interval', 30)),
+                   full_every=int(settings.get('chattr.snapshot_full_every',
+                                               10)))
+
+    def region(self, region):
+        """
+        Snapshots of one region of a sharded world, in a directory of their
+        own.
+        """
+        return type(self)(os.path.join(self.directory, 'region-%d' % region),
+                          self.interval, self.full_every)
+
+    def restore(self, world):
+        """
+        Restore the NPCs of the latest snapshots into `world`, returns how
+        many were restored.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+
+        files = snapshot_files(self.directory)
+        fulls = [i for i, (seq, kind, path) in enumerate(files)
+                 if kind == FULL]
+        if files:
+            self.seq = files[-1][0]
+        if not fulls:
+            return 0
+
+        start = time.time()
+        state = {}
+
+        for seq, kind, path in files[fulls[-1]:]:
+            header, exported, removed = read_snapshot(path)
+
+            for uid in removed:
+                state.pop(uid, None)
+
+            for name, avatar in exported:
+                state[avatar['uid']] = name, avatar
+
+        for exported in state.itervalues():
+            restore_avatar(world, exported)
+
+        log.info('restored %d NPCs from %s in %.3fs', len(state),
+                 self.directory, time.time() - start)
+        return len(state)
+
+    def start(self, world):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.world = world
+        world.avatars.track_changes()
+
+        self.pauses = world.metrics.histogram(
+            'chattr_snapshot_pause_seconds',
+            'Time the world stopped for to write a slice of a snapshot',
+            buckets=self.PAUSE_BUCKETS)
+        self.durations = world.metrics.histogram(
+            'chattr_snapshot_seconds', 'Time taken to write a snapshot')
+        self.taken = world.metrics.counter(
+            'chattr_snapshots_total', 'Snapshots written')
+        self.failures = world.metrics.counter(
+            'chattr_snapshot_failures_total', 'Snapshots that failed')
+
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.take()
+
+    def take(self):
+        full = (self.since_full is None or
+                self.since_full + 1 >= self.full_every)
+
+        self.seq += 1
+
+        try:
+            with self.durations.time():
+                self.write(self.seq, full)
+        except (IOError, OSError), e:
+            # the changes it had are lost with it
+            log.error('Error writing snapshot: %s', e)
+            self.failures.inc()
+            self.since_full = None
+            return False
+
+        self.taken.inc()
+        self.since_full = 0 if full else self.since_full + 1
+        return True
+
+    def write(self, seq, full):
+        avatars = self.world.avatars
+        changed, removed = avatars.take_changes()
+
+        if full:
+            todo = iter(avatars.all())
+            removed = ()
+        else:
+            todo = itertools.chain(*changed)
+
+        header = {'seq': seq, 'kind': FULL if full else INCREMENTAL,
+                  'time': time.time(), 'clock': self.world.clock}
+
+        path = os.path.join(self.directory,
+                            '%08d.%s' % (seq, header['kind']))
+        tmp = path + '.tmp'
+
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+
+                while True:
+                    with self.pauses.time():
+                        part = list(itertools.islice(todo, self.SLICE))
+                        pickle.dump([export_avatar(avatar) for avatar in part
+                                     if isinstance(avatar, NPC)],
+                                    f, pickle.HIGHEST_PROTOCOL)
+
+                    if not part:
+                        break
+
+                    gevent.sleep(0)
+
+                pickle.dump(None, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(list(removed), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+
+                # off the loop, the disk may take a while
+                gevent.get_hub().threadpool.apply(os.fsync, (f.fileno(),))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        os.rename(tmp, path)
+
+        # nothing before a full snapshot is needed any more
+        if full:
+            for old, kind, old_path in snapshot_files(self.directory):
+                if old < seq:
+                    os.remove(old_path)
@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid over the world, bucketing objects by the block of map tiles
+    they stand on.  Each cell is `cell_tiles` x `cell_tiles` tiles, so range
+    queries only visit the handful of cells overlapping the query area instead
+    of every object in the world.
+    """
+
+    def __init__(self, tile_size, cell_tiles=8):
+        self.cell_size = tile_size * cell_tiles
+        self.cells = defaultdict(set)
+        self.keys = dict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, obj):
+        return obj in self.keys
+
+    def key(self, position):
+        return (int(position.x) // self.cell_size,
+                int(position.y) // self.cell_size)
+
+    def insert(self, obj):
+        key = self.key(obj.position)
+        self.keys[obj] = key
+        self.cells[key].add(obj)
+
+    def remove(self, obj):
+        key = self.keys.pop(obj, None)
+        if key is None:
+            return
+
+        cell = self.cells[key]
+        cell.discard(obj)
+        if not cell:
+            del self.cells[key]
+
+    def update(self, obj):
+        key = self.key(obj.position)
+        old = self.keys.get(obj)
+
+        if old == key:
+            return
+
+        if old is not None:
+            cell = self.cells[old]
+            cell.discard(obj)
+            if not cell:
+                del self.cells[old]
+
+        self.keys[obj] = key
+        self.cells[key].add(obj)
+
+    def keys_in_rect(self, x0, y0, x1, y1):
+        cx0, cy0 = int(x0) // self.cell_size, int(y0) // self.cell_size
+        cx1, cy1 = int(x1) // self.cell_size, int(y1) // self.cell_size
+
+        return [(cx, cy) for cy in xrange(cy0, cy1 + 1)
+                for cx in xrange(cx0, cx1 + 1)]
+
+    def cells_in_rect(self, x0, y0, x1, y1):
+        cx0, cy0 = int(x0) // self.cell_size, int(y0) // self.cell_size
+        cx1, cy1 = int(x1) // self.cell_size, int(y1) // self.cell_size
+        cells = self.cells
+
+        for cy in xrange(cy0, cy1 + 1):
+            for cx in xrange(cx0, cx1 + 1):
+                cell = cells.get((cx, cy))
+                if cell:
+                    yield cell
+
+    def rect(self, x0, y0, x1, y1):
+        rv = []
+
+        for cell in self.cells_in_rect(x0, y0, x1, y1):
+            for obj in cell:
+                x, y = obj.position.x, obj.position.y
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    rv.append(obj)
+
+        return rv
+
+    def radius(self, center, radius):
+        cx, cy = center.x, center.y
+        r2 = radius * radius
+        rv = []
+
+        for cell in self.cells_in_rect(cx - radius, cy - radius,
+                                       cx + radius, cy + radius):
+            for obj in cell:
+                dx = obj.position.x - cx
+                dy = obj.position.y - cy
+                if dx * dx + dy * dy < r2:
+                    rv.append(obj)
+
+        return rv
@@ -134,7 +134,79 @@ $(document).ready(function() {
         }
     };
 
+    // server time as the client sees it, frames are stamped with the world
+    // time of the state they carry
+    var Clock = {
+        offset: null,
+        sync: function(time) {
+            var offset = time - Date.now();
+
+            if(this.offset === null)
+                this.offset = offset;
+            else
+                this.offset += 0.1 * (offset - this.offset);
+        },
+        now: function() {
+            return Date.now() + (this.offset || 0);
+        }
+    };
+
+    // everybody else is drawn a couple of frames in the past, in between the
+    // frames either side, so they move smoothly however far apart frames are
+    var Motion = {
+        speed: 0.01,
+        interval: 100,
+        max_extrapolation: 500,
+        delay: function() {
+            return 2 * this.interval;
+        }
+    };
+
+    // the client's own avatar is drawn where it will be once the inputs the
+    // server has not acknowledged yet are applied, on top of the latest
+    // position from the server, so it answers keys straight away
+    var Prediction = {
+        uid: null,
+        seq: 0,
+        pending: [],
+        moves: {
+            UP: [0, -1],
+            DOWN: [0, 1],
+            LEFT: [-1, 0],
+            RIGHT: [1, 0]
+        },
+        input: function(key) {
+            this.seq++;
+            this.pending.push({seq: this.seq, key: key, sent: Date.now()});
+            send('input', {key: key, seq: this.seq});
+        },
+        acknowledge: function(ack) {
+            // inputs dropped by the server are never acknowledged, give up
+            // on them after a while
+            var expired = Date.now() - 1000;
+
+            while(this.pending.length && (this.pending[0].seq <= ack ||
+                                          this.pending[0].sent < expired))
+                this.pending.shift();
+        },
+        position: function(avatar, time) {
+            var last = avatar.latest();
+            var elapsed = Math.min(Math.max(time - last.time, 0),
+                                   Motion.max_extrapolation);
+            var position = avatar.extrapolate(last.position, elapsed);
+
+            for(var i=0; i<this.pending.length; i++) {
+                var move = this.moves[this.pending[i].key];
+                if(move)
+                    position = [position[0] + move[0], position[1] + move[1]];
+            }
+
+            return position;
+        }
+    };
+
     function Avatar(data) {
+        this.samples = [];
         this.update(data)
     }
 
@@ -143,10 +215,77 @@ $(document).ready(function() {
             this[i] = data[i];
     }
 
+    // remember where the avatar was as of a frame
+    Avatar.prototype.sample = function(time) {
+        var samples = this.samples;
+        samples.push({time: time, position: this.position.slice(0)});
+
+        while(samples.length > 2 && samples[1].time < time - 1000)
+            samples.shift();
+    }
+
+    Avatar.prototype.latest = function() {
+        if(this.samples.length)
+            return this.samples[this.samples.length - 1];
+
+        return {time: Clock.now(), position: this.position};
+    }
+
+    // keep heading for the waypoint, as the server does
+    Avatar.prototype.extrapolate = function(position, elapsed) {
+        if(!this.waypoint)
+            return position;
+
+        var dx = this.waypoint[0] - position[0];
+        var dy = this.waypoint[1] - position[1];
+        var distance = Math.sqrt(dx * dx + dy * dy);
+
+        if(distance == 0)
+            return position;
+
+        var step = Math.min(Motion.speed * elapsed, distance);
+        return [position[0] + dx / distance * step,
+                position[1] + dy / distance * step];
+    }
+
+    Avatar.prototype.interpolate = function(time) {
+        var samples = this.samples;
+
+        if(!samples.length)
+            return this.position;
+
+        if(time <= samples[0].time)
+            return samples[0].position;
+
+        for(var i=1; i<samples.length; i++) {
+            var a = samples[i - 1];
+            var b = samples[i];
+
+            if(time <= b.time) {
+                var t = (time - a.time) / (b.time - a.time);
+                return [a.position[0] + (b.position[0] - a.position[0]) * t,
+                        a.position[1] + (b.position[1] - a.position[1]) * t];
+            }
+        }
+
+        // frames are late, carry on for a little while
+        var last = samples[samples.length - 1];
+        return this.extrapolate(last.position,
+                                Math.min(time - last.time,
+                                         Motion.max_extrapolation));
+    }
+
     Avatar.prototype.draw = function(images) {
+        var position;
+
+        if(this.uid == Prediction.uid)
+            position = Prediction.position(this, Clock.now());
+        else
+            position = this.interpolate(Clock.now() - Motion.delay());
+
         draw_tile(images.character, tile_size, 0, 0,
-                  this.position[0] - tile_size/2,
-                  this.position[1] - tile_size/2)
+                  position[0] - tile_size/2,
+                  position[1] - tile_size/2)
 
         if(this.waypoint) {
             context.beginPath();
@@ -167,39 +306,66 @@ $(document).ready(function() {
                           this.size * 2);
     }
 
-    function MapChunk() {
+    // the map arrives in chunks as the avatar moves, keyed by chunk id
+    function MapChunks() {
         this.tiles = null;
-        this.chunk = null;
+        this.chunks = {};
+
+        // chunks further than radius chunks from the avatar are dropped, a
+        // chunk past the server's, which resends them when they come back
+        this.size = 16;
+        this.radius = 4;
     }
 
-    MapChunk.prototype.set_tiles = function(tiles) {
+    MapChunks.prototype.set_tiles = function(tiles) {
         this.tiles = tiles;
     }
 
-    MapChunk.prototype.update = function(chunk) {
-        this.chunk = chunk;
+    MapChunks.prototype.update = function(chunk) {
+        this.chunks[chunk.id] = chunk;
     }
 
-    MapChunk.prototype.draw = function(images) {
-        for(var i=0; i<this.chunk.length; i++) {
-            for(var j=0; j<this.chunk[i].length; j++) {
-                var tile = this.tiles[this.chunk[i][j]];
-                draw_tile(images.terrain,
-                          tile.w,
-                          tile.x,
-                          tile.y,
-                          from_tile_pos(j),
-                          from_tile_pos(i));
+    MapChunks.prototype.evict = function(position) {
+        var size = this.size;
+        var cx = Math.floor(to_tile_pos(position[0]) / size);
+        var cy = Math.floor(to_tile_pos(position[1]) / size);
+
+        for(var id in this.chunks) {
+            var chunk = this.chunks[id];
+            if(Math.max(Math.abs(chunk.x / size - cx),
+                        Math.abs(chunk.y / size - cy)) > this.radius)
+                delete this.chunks[id];
+        }
+    }
+
+    MapChunks.prototype.draw = function(images) {
+        for(var id in this.chunks) {
+            var chunk = this.chunks[id];
+
+            for(var i=0; i<chunk.data.length; i++) {
+                for(var j=0; j<chunk.data[i].length; j++) {
+                    var tile = this.tiles[chunk.data[i][j]];
+                    draw_tile(images.terrain,
+                              tile.w,
+                              tile.x,
+                              tile.y,
+                              from_tile_pos(chunk.x + j),
+                              from_tile_pos(chunk.y + i));
+                }
             }
         }
     }
 
-    window.Map = new MapChunk();
+    window.Map = new MapChunks();
     
-    var host = 'ws://' + window.location.host + '/end-point'
+    // binary frames need typed arrays, otherwise stick to json
+    var protocol = window.DataView ? 'binary' : 'json';
+
+    var host = 'ws://' + window.location.host + '/end-point?protocol=' + protocol
 
     console.log('opening websocket to', host);
     var socket = new WebSocket(host);
+    socket.binaryType = 'arraybuffer';
 
     function message(type, data) {
         return JSON.stringify({'type': type, 'data': data})
@@ -217,6 +383,15 @@ $(document).ready(function() {
         notice: function(data) {
             Log.notice(data);
         },
+        welcome: function(data) {
+            console.log('welcome', data.uid);
+            Prediction.uid = data.uid;
+            Motion.speed = data.speed;
+            Motion.interval = data.interval;
+            Clock.sync(data.time);
+            Map.size = data.chunk_size;
+            Map.radius = data.chunk_radius;
+        },
         tiles: function(data) {
             console.log('tiles');
             Map.set_tiles(data);
@@ -231,8 +406,8 @@ $(document).ready(function() {
         },        
         die: function(data) {
             console.log('die');
-            Avatars.die(data);
-        },        
+            Avatars.remove(data);
+        },
         state: function(data) {
             console.log('state');
 
@@ -240,7 +415,46 @@ $(document).ready(function() {
                 Avatars.add(new Avatar(data[i]));
         }, 
         update: function(data) {
-            Avatars.get(data.uid).update(data);
+            var avatar = Avatars.get(data.uid);
+            if(avatar)
+                avatar.update(data);
+        },
+        frame: function(data) {
+            // a full frame is a snapshot of everything in view
+            if(data.full) {
+                var seen = {};
+                var snapshot = data.spawn.concat(data.update);
+                for(var i=0; i<snapshot.length; i++)
+                    seen[snapshot[i].uid] = true;
+
+                for(var uid in Avatars.avatars)
+                    if(!(uid in seen))
+                        Avatars.remove(uid);
+            }
+
+            for(var i=0; i<data.spawn.length; i++)
+                Avatars.add(new Avatar(data.spawn[i]));
+
+            for(var i=0; i<data.update.length; i++) {
+                if(data.full && !Avatars.get(data.update[i].uid))
+                    Avatars.add(new Avatar(data.update[i]));
+                else
+                    MessageHandlers.update(data.update[i]);
+            }
+
+            for(var i=0; i<data.despawn.length; i++)
+                Avatars.remove(data.despawn[i]);
+
+            // avatars missing from the frame have not moved since the last
+            Clock.sync(data.time);
+            for(var uid in Avatars.avatars)
+                Avatars.avatars[uid].sample(data.time);
+
+            Prediction.acknowledge(data.ack);
+
+            var own = Avatars.get(Prediction.uid);
+            if(own)
+                Map.evict(own.latest().position);
         }
     };
    
@@ -248,8 +462,138 @@ $(document).ready(function() {
         console.log('websocket opened');
     };
     
+    // see chattr/protocol.py for the layout of binary messages
+    var Binary = {
+        FRAME: 1,
+        CHUNK: 2,
+        FULL: 1,
+        WAYPOINT_CLEARED: 32,
+        POSITION_SCALE: 16,
+        VELOCITY_SCALE: 256,
+
+        decode: function(buffer) {
+            var reader = new BinaryReader(buffer);
+            var type = reader.uint8();
+
+            if(type == this.FRAME)
+                return {type: 'frame', data: this.frame(reader)};
+            else if(type == this.CHUNK)
+                return {type: 'chunk', data: this.chunk(reader)};
+
+            return {type: 'unknown:' + type, data: null};
+        },
+        frame: function(reader) {
+            var frame = {tick: reader.uint32(), time: reader.float64(),
+                         ack: reader.uint32(), spawn: [], update: [], despawn: []};
+            frame.full = (reader.uint8() & this.FULL) != 0;
+
+            for(var i=0, n=reader.uint16(); i<n; i++)
+                frame.spawn.push(this.avatar(reader));
+
+            for(var i=0, n=reader.uint16(); i<n; i++)
+                frame.update.push(this.avatar(reader));
+
+            for(var i=0, n=reader.uint16(); i<n; i++)
+                frame.despawn.push(reader.uid());
+
+            return frame;
+        },
+        avatar: function(reader) {
+            var avatar = {uid: reader.uid()};
+            var mask = reader.uint8();
+
+            if(mask & 1)
+                avatar.size = reader.uint8();
+            if(mask & 2)
+                avatar.position = reader.vector('int32', this.POSITION_SCALE);
+            if(mask & 4)
+                avatar.velocity = reader.vector('int16', this.VELOCITY_SCALE);
+            if(mask & 8)
+                avatar.rotation = reader.int16();
+            if(mask & 16)
+                avatar.waypoint = reader.vector('int32', this.POSITION_SCALE);
+            if(mask & this.WAYPOINT_CLEARED)
+                avatar.waypoint = null;
+
+            return avatar;
+        },
+        chunk: function(reader) {
+            var chunk = {id: reader.uint32(), x: reader.uint16(), y: reader.uint16()};
+            var width = reader.uint16();
+            var height = reader.uint16();
+            var rows = [];
+
+            for(var i=0; i<height; i++) {
+                var row = [];
+                for(var j=0; j<width; j++)
+                    row.push(reader.uint16());
+                rows.push(row);
+            }
+
+            chunk.data = rows;
+            return chunk;
+        }
+    };
+
+    function BinaryReader(buffer) {
+        this.view = new DataView(buffer);
+        this.offset = 0;
+    }
+
+    BinaryReader.prototype.uint8 = function() {
+        return this.view.getUint8(this.offset++);
+    }
+
+    BinaryReader.prototype.uint16 = function() {
+        var rv = this.view.getUint16(this.offset, true);
+        this.offset += 2;
+        return rv;
+    }
+
+    BinaryReader.prototype.int16 = function() {
+        var rv = this.view.getInt16(this.offset, true);
+        this.offset += 2;
+        return rv;
+    }
+
+    BinaryReader.prototype.uint32 = function() {
+        var rv = this.view.getUint32(this.offset, true);
+        this.offset += 4;
+        return rv;
+    }
+
+    BinaryReader.prototype.int32 = function() {
+        var rv = this.view.getInt32(this.offset, true);
+        this.offset += 4;
+        return rv;
+    }
+
+    BinaryReader.prototype.float64 = function() {
+        var rv = this.view.getFloat64(this.offset, true);
+        this.offset += 8;
+        return rv;
+    }
+
+    BinaryReader.prototype.vector = function(type, scale) {
+        return [this[type]() / scale, this[type]() / scale];
+    }
+
+    BinaryReader.prototype.uid = function() {
+        var hex = '';
+        for(var i=0; i<16; i++) {
+            var b = this.uint8();
+            hex += (b < 16 ? '0' : '') + b.toString(16);
+        }
+        return hex;
+    }
+
     socket.onmessage = function(msg) {
-        obj = JSON.parse(msg.data);
+        var obj;
+
+        if(typeof msg.data == 'string')
+            obj = JSON.parse(msg.data);
+        else
+            obj = Binary.decode(msg.data);
 
         if(obj.type in MessageHandlers)
             MessageHandlers[obj.type](obj.data);
@@ -279,7 +623,7 @@ $(document).ready(function() {
         if(evt.keyCode in Keys) {
             var key = Keys[evt.keyCode]
             console.log('pressed', key)
-            send('input', key);
+            Prediction.input(key);
         }
     });
 
@@ -306,13 +650,20 @@ $(document).ready(function() {
     
     function main(images) {
 
+        // draw as often as the browser will, motion is interpolated between
+        // frames from the server
+        var request_frame = window.requestAnimationFrame || function(fn) {
+            window.setTimeout(fn, 1000 / 60);
+        };
+
         function renderer() {
             context.clearRect(0, 0, context.canvas.width, context.canvas.height)
             Map.draw(images);
             Avatars.draw(images);
+            request_frame(renderer);
         }
 
-        window.setInterval(renderer, 50);
+        request_frame(renderer);
     }
 
     console.log('loading images...')
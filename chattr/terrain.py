@@ -0,0 +1,258 @@
+# -----------------------------------------------------------------------------
+#
+# Terrain
+#
+# Maps and their tiles, loaded from JSON or from the binary format, which is
+# mmapped so the tile grid of a large map is only paged in where it is used.
+# Nothing here needs gevent or pyramid, map.py builds maps without starting a
+# server.
+# -----------------------------------------------------------------------------
+
+import json
+import mmap
+import numpy
+import struct
+
+from chattr.pathfinding import BLOCKED, Pathfinder
+from chattr.vector import Vector
+
+
+class Tile(object):
+    def __init__(self, name, x, y, w, h, flags=None):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.flags = set(flags or '')
+
+    def __json__(self):
+        return self.to_dict()
+
+    def to_dict(self):
+        return dict((k, v) for k, v in vars(self).items() if k != 'flags')
+
+
+# FIXME switch to Point for coords
+class Map(object):
+    # Binary map files are a fixed header, a JSON tile table and the raw tile
+    # grid, row major, starting at a page aligned offset so it can be mmapped
+    #
+    #   4s magic, H version, I width, I height, H tile size, B bytes per tile,
+    #   I length of the tile table
+    MAGIC = 'CHMP'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHIIHBI')
+    ALIGN = mmap.ALLOCATIONGRANULARITY
+
+    # terrain is streamed to clients in square chunks of this many tiles
+    CHUNK_SIZE = 16
+
+    def __init__(self, tiles, data, tile_map, tile_size=32):
+        self.tiles = tiles
+        self.data = numpy.asanyarray(data, dtype=self.dtype(tiles))
+        self.tile_map = tile_map
+        self.tile_size = tile_size
+        self._pathfinder = None
+
+    @staticmethod
+    def dtype(tiles):
+        return numpy.uint8 if len(tiles) <= 256 else numpy.uint16
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            is_binary = f.read(len(cls.MAGIC)) == cls.MAGIC
+
+        if is_binary:
+            return cls.open(path)
+
+        return cls.load_json(path)
+
+    @classmethod
+    def load_json(cls, path):
+        rv = None
+
+        with open(path) as f:
+            obj = json.load(f)
+
+            tiles = [Tile(**i) for i in obj['tiles']]
+            data = obj['data']
+            tile_map = obj['tile_map']
+
+            rv = cls(tiles, data, tile_map)
+
+        return rv
+
+    @classmethod
+    def read_header(cls, f):
+        (magic, version, width, height, tile_size, itemsize,
+         table_size) = cls.HEADER.unpack(f.read(cls.HEADER.size))
+
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('%s is not a version %d map file' %
+                             (f.name, cls.VERSION))
+
+        table = json.loads(f.read(table_size))
+        tiles = [Tile(**i) for i in table['tiles']]
+        dtype = numpy.dtype('<u%d' % itemsize)
+
+        offset = cls.data_offset(cls.HEADER.size + table_size)
+
+        return tiles, table['tile_map'], tile_size, (height, width), dtype, \
+            offset
+
+    @classmethod
+    def data_offset(cls, size):
+        return (size + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """
+        Map a binary map file into memory, tiles are paged in from disk as
+        chunks are read so startup does not depend on the size of the map.
+        """
+        with open(path, 'rb') as f:
+            tiles, tile_map, tile_size, shape, dtype, offset = \
+                cls.read_header(f)
+
+        data = numpy.memmap(path, dtype=dtype, mode=mode, offset=offset,
+                            shape=shape)
+
+        return cls(tiles, data, tile_map, tile_size)
+
+    @classmethod
+    def write_header(cls, f, tiles, tile_map, tile_size, shape, dtype):
+        table = json.dumps({
+            'tiles': [dict(t.to_dict(), flags=''.join(sorted(t.flags)))
+                      for t in tiles],
+            'tile_map': tile_map})
+
+        height, width = shape
+        f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, width, height,
+                                tile_size, numpy.dtype(dtype).itemsize,
+                                len(table)))
+        f.write(table)
+
+        offset = cls.data_offset(cls.HEADER.size + len(table))
+        f.write('\0' * (offset - f.tell()))
+        return offset
+
+    @classmethod
+    def create(cls, path, tiles, tile_map, width, height, tile_size=32):
+        """
+        Create an empty binary map file and return it opened for writing, for
+        maps too large to build in memory first.
+        """
+        dtype = numpy.dtype(cls.dtype(tiles)).newbyteorder('<')
+
+        with open(path, 'wb') as f:
+            offset = cls.write_header(f, tiles, tile_map, tile_size,
+                                      (height, width), dtype)
+            f.truncate(offset + width * height * dtype.itemsize)
+
+        return cls.open(path, mode='r+')
+
+    def save(self, path):
+        dtype = self.data.dtype.newbyteorder('<')
+
+        with open(path, 'wb') as f:
+            self.write_header(f, self.tiles, self.tile_map, self.tile_size,
+                              self.data.shape, dtype)
+
+            # a strip of rows at a time, the map might be mmapped and huge
+            for row in xrange(0, self.height, 1024):
+                strip = self.data[row:row + 1024]
+                numpy.ascontiguousarray(strip, dtype=dtype).tofile(f)
+
+    def position(self, p):
+        return Vector(int(p.x) // self.tile_size, int(p.y) // self.tile_size)
+
+    def clamp(self, x, y):
+        return (min(max(x, 0), self.width - 1),
+                min(max(y, 0), self.height - 1))
+
+    def get(self, position):
+        x, y = self.clamp(*self.position(position))
+        return self.tiles[self.data[y, x]]
+
+    def passable(self, position):
+        if position.x < 0 or position.y < 0:
+            return False
+
+        # off the map counts as blocked
+        x = int(position.x) // self.tile_size
+        y = int(position.y) // self.tile_size
+        height, width = self.data.shape
+        if x >= width or y >= height:
+            return False
+
+        # ids missing from the tile table are never passable
+        tile = self.data[y, x]
+        return tile < len(self.tiles) and BLOCKED not in self.tiles[tile].flags
+
+    def chunk(self, position, s):
+        """
+        The s x s block of tiles centered on position, shifted to stay inside
+        the map.  This is a view on the map data, not a copy.
+        """
+        x, y = self.position(position)
+        px = min(max(x - s // 2, 0), max(self.width - s, 0))
+        py = min(max(y - s // 2, 0), max(self.height - s, 0))
+
+        return self.data[py:py + s, px:px + s]
+
+    @property
+    def chunks_wide(self):
+        return -(-self.width // self.CHUNK_SIZE)
+
+    @property
+    def chunks_tall(self):
+        return -(-self.height // self.CHUNK_SIZE)
+
+    def chunk_id(self, position):
+        x, y = self.clamp(*self.position(position))
+        return (y // self.CHUNK_SIZE) * self.chunks_wide + x // self.CHUNK_SIZE
+
+    def chunk_distance(self, a, b):
+        """
+        How many chunks apart chunks a and b are, diagonals counting as one.
+        """
+        ay, ax = divmod(a, self.chunks_wide)
+        by, bx = divmod(b, self.chunks_wide)
+        return max(abs(ax - bx), abs(ay - by))
+
+    def chunks_around(self, cid, r):
+        """
+        Ids of the chunks within r chunks of chunk cid, clipped to the map.
+        """
+        cy, cx = divmod(cid, self.chunks_wide)
+
+        for y in xrange(max(cy - r, 0), min(cy + r + 1, self.chunks_tall)):
+            for x in xrange(max(cx - r, 0), min(cx + r + 1, self.chunks_wide)):
+                yield y * self.chunks_wide + x
+
+    def get_chunk(self, cid):
+        cy, cx = divmod(cid, self.chunks_wide)
+        x, y = cx * self.CHUNK_SIZE, cy * self.CHUNK_SIZE
+        data = self.data[y:y + self.CHUNK_SIZE, x:x + self.CHUNK_SIZE]
+        return {'id': cid, 'x': x, 'y': y, 'data': data}
+
+    @property
+    def pathfinder(self):
+        # built on first use, it scans the whole map
+        if self._pathfinder is None:
+            self._pathfinder = Pathfinder(self)
+
+        return self._pathfinder
+
+    def find_path(self, origin, goal):
+        return self.pathfinder.find(origin, goal)
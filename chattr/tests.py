@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from chattr import Channel, Map, Tile, Wanderer, WorldThread
+from chattr.replay import Replay, ReplayLog
+from chattr.scheduler import Scheduler
+
+
+class NullSocket(object):
+    def send(self, frame):
+        pass
+
+    def receive(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class ReplayTests(unittest.TestCase):
+    # small tiles keep the view radius, 25 tiles, well inside the 640 pixels
+    # avatars spawn in, so some NPCs are near players and some are not
+    TILE_SIZE = 4
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_map(self):
+        return Map([Tile('grass', 0, 1, self.TILE_SIZE, self.TILE_SIZE)],
+                   numpy.zeros((160, 160)), 'terrain-tiles',
+                   tile_size=self.TILE_SIZE)
+
+    def run_ticks(self, world, count):
+        for i in range(count):
+            world.tick(world.scheduler.step)
+            world.ticks += 1
+
+    def positions(self, world):
+        return dict((avatar.uid, tuple(avatar.position))
+                    for avatar in world.avatars.all())
+
+    def test_replay_with_players_at_level_1(self):
+        scheduler = Scheduler(tps=10, degrade=False, far_stride=4)
+        scheduler.level = 1
+
+        world = WorldThread(self.make_map(), scheduler, seed=1,
+                            replayable=True)
+
+        recorder = ReplayLog(self.path)
+        recorder.start(world)
+
+        for i in range(40):
+            world.spawn(Wanderer, args=(100,))
+
+        players = [world.spawn() for i in range(3)]
+        for avatar in players:
+            world.attach(avatar, Channel(NullSocket()))
+
+        self.run_ticks(world, 30)
+
+        # a player leaving part way changes which NPCs are near
+        world.detach(players[0])
+        world.kill(players[0])
+
+        self.run_ticks(world, 30)
+        recorder.stop()
+
+        far = [avatar for avatar in world.avatars.all()
+               if world.avatars.index.keys.get(avatar)
+               not in world.near_players()]
+        self.assertTrue(far, 'every NPC is near a player')
+
+        replay = Replay(self.make_map(), self.path)
+        replay.run()
+
+        self.assertEqual(replay.world.ticks, world.ticks)
+        self.assertEqual(self.positions(replay.world), self.positions(world))
+
+    def test_only_replayable_worlds_hash_by_uid(self):
+        world = WorldThread(self.make_map(), seed=1)
+        avatar = world.spawn(Wanderer, args=(100,))
+        self.assertEqual(hash(avatar), object.__hash__(avatar))
+        self.assertRaises(ValueError, ReplayLog(self.path).start, world)
+
+        world = WorldThread(self.make_map(), seed=1, replayable=True)
+        avatar = world.spawn(Wanderer, args=(100,))
+        self.assertEqual(hash(avatar), hash(avatar.uid))
+        self.assertTrue(isinstance(avatar, Wanderer))
+        self.assertEqual(type(avatar).__name__, 'Wanderer')
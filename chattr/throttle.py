@@ -0,0 +1,148 @@
+# -----------------------------------------------------------------------------
+#
+# Input throttling
+#
+# Clients are rate limited per message type with token buckets as messages
+# are read off their socket, so a flood never reaches the world.  What gets
+# through is queued for the world, where messages that supersede each other
+# are coalesced and each tick only dispatches a bounded number of them.  The
+# queue itself is bounded too, many clients each within their limits can
+# still add up to more than the world keeps up with.
+# -----------------------------------------------------------------------------
+
+from collections import deque
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average and bursts of up to `burst`.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time() if now is None else now
+
+    def take(self, now=None):
+        if now is None:
+            now = time.time()
+
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.tokens + elapsed * self.rate, self.burst)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter(object):
+    """
+    A bucket per message type plus one shared by every message, `limits` maps
+    message types to (rate, burst) and the None key is the overall limit.
+    Types without their own limit only count against the overall one.
+    """
+
+    def __init__(self, limits):
+        now = time.time()
+        self.buckets = dict((type_, TokenBucket(rate, burst, now))
+                            for type_, (rate, burst) in limits.items())
+
+    def allow(self, type_, now=None):
+        if now is None:
+            now = time.time()
+
+        bucket = self.buckets.get(type_)
+        if bucket is not None and not bucket.take(now):
+            return False
+
+        overall = self.buckets.get(None)
+        return overall is None or overall.take(now)
+
+
+class InputQueue(object):
+    """
+    Messages waiting to be dispatched by the world, in arrival order.  A
+    message of a type in `coalesce` replaces one of the same type from the
+    same avatar that is still waiting, in place, since only the latest one
+    matters.
+
+    Past `limit` waiting messages the oldest coalescible one is shed to make
+    room, or the new message is dropped when there is none.  Required
+    messages, the world's own, are always queued.
+    """
+
+    def __init__(self, coalesce=(), limit=None):
+        self.coalesce = frozenset(coalesce)
+        self.limit = limit
+        self.entries = deque()
+        self.pending = dict()
+        self.coalesced = 0
+        self.shed = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def qsize(self):
+        return len(self.entries)
+
+    def full(self):
+        return self.limit is not None and len(self.entries) >= self.limit
+
+    def put(self, avatar, msg, required=False):
+        type_ = msg.get('type')
+        key = avatar, type_
+
+        if type_ in self.coalesce:
+            entry = self.pending.get(key)
+
+            if entry is not None:
+                entry[1] = msg
+                self.coalesced += 1
+                return
+
+        if self.full() and not required and not self.shed_oldest():
+            self.shed += 1
+            return
+
+        entry = [avatar, msg]
+        if type_ in self.coalesce:
+            self.pending[key] = entry
+
+        self.entries.append(entry)
+
+    def shed_oldest(self):
+        """
+        Drop the oldest waiting coalescible message, False if there is none.
+        """
+        for i, (avatar, msg) in enumerate(self.entries):
+            type_ = msg.get('type')
+
+            if type_ in self.coalesce:
+                del self.entries[i]
+                del self.pending[avatar, type_]
+                self.shed += 1
+                return True
+
+        return False
+
+    def take(self, limit=None):
+        """
+        Yield up to `limit` waiting messages, the rest wait for the next call.
+        """
+        entries = self.entries
+        pending = self.pending
+
+        n = len(entries) if limit is None else min(limit, len(entries))
+
+        for i in xrange(n):
+            avatar, msg = entries.popleft()
+
+            if msg.get('type') in self.coalesce:
+                pending.pop((avatar, msg['type']), None)
+
+            yield avatar, msg
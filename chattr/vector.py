@@ -1,4 +1,5 @@
 import math
+import numpy
 
 
 class Vector(object):
@@ -17,6 +18,10 @@ class Vector(object):
     def __json__(self):
         return list(self)
 
+    def __reduce__(self):
+        # much cheaper to pickle than the default for slots
+        return Vector, (self.x, self.y)
+
     def __add__(self, vec):
         if not isinstance(vec, Vector):
             raise TypeError('Cannot add Vector and %s' % vec)
@@ -65,12 +70,21 @@ class Vector(object):
         return 2
 
     def __getitem__(self, index):
+        if index == 0:
+            return self.x
+        if index == 1:
+            return self.y
+
+        # negative indexes and slices
         return (self.x, self.y)[index]
 
     def __setitem__(self, index, value):
-        temp = [self.x, self.y]
-        temp[index] = value
-        self.x, self.y = temp
+        if index == 0 or index == -2:
+            self.x = value
+        elif index == 1 or index == -1:
+            self.y = value
+        else:
+            raise IndexError('Vector index out of range')
 
     def __iter__(self):
         yield self.x
@@ -94,12 +108,48 @@ class Vector(object):
     def zero(self):
         self.x = self.y = 0
 
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+        return self
+
+    # In place versions of the operators, for inner loops.  The *_into ones
+    # write their result into `out`, which may be self, and return it
+
+    def add_into(self, vec, out):
+        out.x = self.x + vec.x
+        out.y = self.y + vec.y
+        return out
+
+    def sub_into(self, vec, out):
+        out.x = self.x - vec.x
+        out.y = self.y - vec.y
+        return out
+
+    def scale_into(self, v, out):
+        out.x = self.x * v
+        out.y = self.y * v
+        return out
+
+    def add_scaled(self, vec, v):
+        self.x += vec.x * v
+        self.y += vec.y * v
+        return self
+
     @property
     def magnitude(self):
         return math.hypot(self.x, self.y)
 
+    @property
+    def magnitude_sq(self):
+        return self.x * self.x + self.y * self.y
+
     def normalize(self):
-        self /= self.magnitude
+        # a zero vector has no direction, it stays zero
+        magnitude = math.hypot(self.x, self.y)
+        if magnitude:
+            self.x /= magnitude
+            self.y /= magnitude
         return self
 
     def unit(self):
@@ -112,8 +162,89 @@ class Vector(object):
         return self.x * vec.y - self.y * vec.x
 
     def distance(self, vec):
-        tmp = vec.copy()
-        tmp -= self
-        return tmp.magnitude
+        return math.hypot(vec.x - self.x, vec.y - self.y)
+
+    def distance_sq(self, vec):
+        dx = vec.x - self.x
+        dy = vec.y - self.y
+        return dx * dx + dy * dy
+
+    def within(self, vec, radius):
+        dx = vec.x - self.x
+        dy = vec.y - self.y
+        return dx * dx + dy * dy <= radius * radius
+
+
+class VectorArray(object):
+    """
+    Many points at once, an n x 2 array with the Vector operations that are
+    worth batching applied to every row.
+    """
+
+    def __init__(self, points=0):
+        if isinstance(points, (int, long)):
+            self.data = numpy.zeros((points, 2))
+        else:
+            self.data = numpy.array(points, dtype=float).reshape(-1, 2)
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        rv = cls(0)
+        rv.data = numpy.array([(v.x, v.y) for v in vectors],
+                              dtype=float).reshape(-1, 2)
+        return rv
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        x, y = self.data[index]
+        return Vector(float(x), float(y))
+
+    def __setitem__(self, index, vec):
+        self.data[index] = vec.x, vec.y
+
+    def __iter__(self):
+        for x, y in self.data.tolist():
+            yield Vector(x, y)
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def y(self):
+        return self.data[:, 1]
+
+    def translate(self, vec):
+        self.data += (vec.x, vec.y)
+        return self
+
+    def add_scaled(self, vectors, v):
+        self.data += vectors.data * v
+        return self
+
+    def magnitude(self):
+        return numpy.hypot(self.data[:, 0], self.data[:, 1])
+
+    def normalize(self):
+        magnitude = self.magnitude()
+        moving = magnitude > 0
+        self.data[moving] /= magnitude[moving, numpy.newaxis]
+        return self
+
+    def distance_sq(self, vec):
+        dx = self.data[:, 0] - vec.x
+        dy = self.data[:, 1] - vec.y
+        return dx * dx + dy * dy
+
+    def distance(self, vec):
+        return numpy.sqrt(self.distance_sq(vec))
+
+    def within(self, vec, radius):
+        """
+        Indexes of the points within `radius` of `vec`.
+        """
+        return numpy.flatnonzero(self.distance_sq(vec) <= radius * radius)
 
 Point = Vector
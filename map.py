@@ -1,16 +1,25 @@
-from mpl_toolkits.mplot3d import axes3d
-import matplotlib.pyplot as plt
+import os
+
+# only the map classes are needed, without gevent patching the processes
+# the map is generated in, or the server's pyramid
+os.environ.setdefault('CHATTR_NO_PATCH', '1')
+
 import numpy as np
-import random
+import argparse
 import json
-import sys
+import tempfile
+import traceback
+
+from chattr.terrain import Map, Tile
 
 SIZE = 100
-DIM = [SIZE, SIZE]
 ITERATIONS = 200
 MIN_RADIUS = .1
 MAX_RADIUS = .5
 
+# rows of the map generated at a time
+STRIP_ROWS = 256
+
 # FIXME sprinkle trees etc
 # FIXME desert/swamp/locality
 
@@ -21,7 +30,7 @@ TILES = [
         'y': 2,
         'w': 32,
         'h': 32,
-        'flags': ''
+        'flags': 'b'
     },
     {
         'name': 'shallow-water',
@@ -85,7 +94,7 @@ TILES = [
         'y': 13,
         'w': 32,
         'h': 32,
-        'flags': ''
+        'flags': 'b'
     },
     {
         'name': 'volcanos',
@@ -93,72 +102,237 @@ TILES = [
         'y': 13,
         'w': 32,
         'h': 32,
-        'flags': ''
+        'flags': 'b'
     }
 ]
 
 
-def generate():
-    x, y, z = np.zeros(DIM), np.zeros(DIM), np.zeros(DIM)
+def hills(size, iterations, seed=None):
+    """
+    Centers, in tiles, and radii of the hills piled up to make the terrain.
+    """
+    rng = np.random.RandomState(seed)
+
+    cx = rng.randint(0, size, iterations)
+    cy = rng.randint(0, size, iterations)
+    hr = rng.uniform(MIN_RADIUS, MAX_RADIUS, iterations)
+
+    return zip(cx.tolist(), cy.tolist(), hr.tolist())
+
+
+def coordinates(size):
+    # the map spans -1 to 1 in both directions
+    return -1 + 2 * np.arange(size) / float(size)
+
+
+def heights(size, hills, row0, row1):
+    """
+    Raw terrain height of rows row0 to row1, each hill only touches the
+    rows and columns within its radius.
+    """
+    coords = coordinates(size)
+    z = np.zeros((row1 - row0, size))
+
+    for cx, cy, hr in hills:
+        reach = int(np.ceil(hr * size / 2.0))
+
+        j0, j1 = max(cy - reach, row0), min(cy + reach + 1, row1)
+        if j0 >= j1:
+            continue
+
+        k0, k1 = max(cx - reach, 0), min(cx + reach + 1, size)
+
+        dx = coords[k0:k1] - coords[cx]
+        dy = coords[j0:j1] - coords[cy]
+
+        bump = hr ** 2 - (dy[:, np.newaxis] ** 2 + dx[np.newaxis, :] ** 2)
+        np.maximum(bump, 0, out=bump)
+
+        z[j0 - row0:j1 - row0, k0:k1] += bump
+
+    return z
+
+
+def normalize(z, zmin, zmax):
+    z = (z - zmin) / (zmax - zmin)
+    return np.square(z)
+
+
+def tile_data(z):
+    # the highest point would round up past the last tile
+    tiles = np.rint(len(TILES) * z)
+    return np.minimum(tiles, len(TILES) - 1).astype(Map.dtype(TILES))
+
 
-    # initialize the arrays
-    for j in range(SIZE):
-        for k in range(SIZE):
-            x[j][k] = -1 + (2 * float(k) / float(SIZE))
-            y[k][j] = -1 + (2 * float(k) / float(SIZE))
+def generate(size=SIZE, iterations=ITERATIONS, seed=None):
+    z = heights(size, hills(size, iterations, seed), 0, size)
+    return normalize(z, z.min(), z.max())
 
-    for i in range(ITERATIONS):
-        print >>sys.stderr, '%.02f' % (float(i) / float(ITERATIONS) * 100)
 
-        cx = random.randint(0, SIZE - 1)
-        cy = random.randint(0, SIZE - 1)
+def strips(size, rows):
+    return [(row, min(row + rows, size)) for row in range(0, size, rows)]
 
-        hx, hy = x[cy][cx], y[cy][cx]
-        hr = random.uniform(MIN_RADIUS, MAX_RADIUS)
 
-        # FIXME can limit to 2R box around center
-        for j in range(SIZE):
-            for k in range(SIZE):
-                px = x[j][k]
-                py = y[j][k]
-                z[j][k] += max(hr ** 2 - ((px - hx) ** 2 + (py - hy) ** 2), 0)
+def parallel(fn, jobs, processes):
+    """
+    Run fn over jobs, split between forked processes.
+    """
+    if processes <= 1:
+        for job in jobs:
+            fn(*job)
+        return
 
-    zmin = z.min()
-    zmax = z.max()
-    z -= zmin
-    z /= (zmax - zmin)
+    pids = []
+    for i in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                for job in jobs[i::processes]:
+                    fn(*job)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
 
-    z = np.square(z)
+        pids.append(pid)
 
-    return x, y, z
+    failed = [pid for pid in pids if os.waitpid(pid, 0)[1]]
+    if failed:
+        raise RuntimeError('%d map workers failed' % len(failed))
 
 
-def render(data):
-    x, y, z = data
+def height_strip(scratch, size, hills, row0, row1):
+    raw = np.memmap(scratch, dtype=np.float32, mode='r+', shape=(size, size))
+    raw[row0:row1] = heights(size, hills, row0, row1)
+    raw.flush()
+
+
+def tile_strip(scratch, path, size, zmin, zmax, row0, row1):
+    raw = np.memmap(scratch, dtype=np.float32, mode='r', shape=(size, size))
+
+    out = Map.open(path, mode='r+')
+    out.data[row0:row1] = tile_data(normalize(raw[row0:row1], zmin, zmax))
+    out.data.flush()
+
+
+def generate_file(path, size=SIZE, iterations=ITERATIONS, seed=None,
+                  processes=1, rows=STRIP_ROWS):
+    """
+    Generate a map a strip of rows at a time straight into a binary map
+    file, never holding the whole map in memory.  Raw heights go to a
+    scratch file first, they are normalized by the extremes of the map.
+    """
+    tiles = [Tile(**t) for t in TILES]
+    Map.create(path, tiles, 'terrain-tiles', size, size)
+
+    fd, scratch = tempfile.mkstemp(suffix='.heights',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+
+    try:
+        np.memmap(scratch, dtype=np.float32, mode='w+',
+                  shape=(size, size)).flush()
+
+        chosen = hills(size, iterations, seed)
+        jobs = strips(size, rows)
+
+        parallel(height_strip,
+                 [(scratch, size, chosen, r0, r1) for r0, r1 in jobs],
+                 processes)
+
+        raw = np.memmap(scratch, dtype=np.float32, mode='r',
+                        shape=(size, size))
+        extremes = [(raw[r0:r1].min(), raw[r0:r1].max()) for r0, r1 in jobs]
+        zmin = min(lo for lo, hi in extremes)
+        zmax = max(hi for lo, hi in extremes)
+        del raw
+
+        parallel(tile_strip,
+                 [(scratch, path, size, zmin, zmax, r0, r1)
+                  for r0, r1 in jobs],
+                 processes)
+    finally:
+        os.remove(scratch)
+
+    return Map.open(path)
+
+
+def render(z):
+    # only needed when plotting
+    from mpl_toolkits.mplot3d import axes3d
+    import matplotlib.pyplot as plt
+
+    # a wireframe of a few hundred lines either way
+    step = max(z.shape[0] // 100, 1)
+    z = np.asarray(z[::step, ::step], dtype=float)
+    coords = coordinates(z.shape[0])
+    x, y = np.meshgrid(coords, coords)
 
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
-    ax.plot_wireframe(x, y, z, rstride=10, cstride=10)
+    ax.plot_wireframe(x, y, z, rstride=1, cstride=1)
 
     plt.show()
 
 
-def dump(data):
-    x, y, z = data
-
-    out = []
-    for i in range(SIZE):
-        out.append([int(round(10 * x)) for x in z[i]])
-
+def dump(z):
     print json.dumps({'tiles': TILES,
-                      'data': out,
+                      'data': tile_data(z).tolist(),
                       'tile_map': 'terrain-tiles'})
 
 
+def convert(src, dst):
+    Map.load_json(src).save(dst)
+
+
 def main():
-    data = generate()
-    dump(data)
-    render(data)
+    parser = argparse.ArgumentParser(description='Generate a chattr map')
+    parser.add_argument('-o', '--output',
+                        help='write a binary map file instead of JSON to '
+                             'stdout')
+    parser.add_argument('--convert', metavar='JSON',
+                        help='convert an existing JSON map to the binary '
+                             'format instead of generating one')
+    parser.add_argument('--size', type=int, default=SIZE,
+                        help='width and height of the map in tiles')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS,
+                        help='number of hills')
+    parser.add_argument('--seed', type=int,
+                        help='seed for a reproducible map')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='generate strips of the map in this many '
+                             'processes, with --output')
+    parser.add_argument('--strip-rows', type=int, default=STRIP_ROWS,
+                        help='rows generated at a time, with --output')
+    parser.add_argument('--render', dest='render', action='store_true',
+                        help='plot the generated terrain, needs matplotlib')
+    parser.add_argument('--no-render', dest='render', action='store_false',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.convert:
+        if not args.output:
+            parser.error('--convert needs an --output file')
+
+        convert(args.convert, args.output)
+        return
+
+    if args.output:
+        generated = generate_file(args.output, args.size, args.iterations,
+                                  args.seed, args.processes, args.strip_rows)
+
+        # scaling the whole grid is as big as the map, only for a plot
+        if args.render:
+            render(generated.data / float(len(TILES) - 1))
+        return
+
+    z = generate(args.size, args.iterations, args.seed)
+    dump(z)
+
+    if args.render:
+        render(z)
 
 if __name__ == '__main__':
     main()
@@ -33,6 +33,9 @@ setup(name='Chattr',
       main = chattr:main
       [paste.server_factory]
       server_factory = chattr:server_factory
+      [console_scripts]
+      chattr-loadtest = chattr.loadtest:main
+      chattr-replay = chattr.replay:main
       """,
       paster_plugins=['pyramid'],
       )